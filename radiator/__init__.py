@@ -7,26 +7,250 @@ import time
 import re
 import types
 import base64
-import random
 import tempfile
+import threading
+import zlib
+import heapq
+import mmap
+import Queue
+from collections import deque, OrderedDict
+from cStringIO import StringIO
 
 logger = logging.getLogger('radiator')
 
 def start_server(reactor,
                  dir=None,
                  fsync_millis=0,
-                 rewrite_interval_secs=300):
-    broker = Broker(dir=dir, fsync_millis=fsync_millis,
-                    rewrite_interval_secs=rewrite_interval_secs)
-    reactor.start_server(broker, blocking=True)
+                 rewrite_interval_secs=300,
+                 group_commit=False,
+                 prefetch_count=1,
+                 memory_queue_max_size=100000,
+                 compress_files=False,
+                 workers=1):
+    def create_broker():
+        return Broker(dir=dir, fsync_millis=fsync_millis,
+                      rewrite_interval_secs=rewrite_interval_secs,
+                      group_commit=group_commit,
+                      prefetch_count=prefetch_count,
+                      memory_queue_max_size=memory_queue_max_size,
+                      compress_files=compress_files)
+    if workers > 1:
+        # forks workers that each own a share of the destinations. see
+        # shard.py
+        from radiator.shard import serve_sharded
+        serve_sharded(reactor, create_broker, workers)
+    else:
+        reactor.start_server(create_broker(), blocking=True)
 
 def now_millis():
     return int(time.time() * 1000)
 
+#
+# A reply to a SEND whose reply-to header starts with REPLY_PREFIX is
+# delivered straight to the connection that sent the request (see
+# Broker.expect_reply).  No destination is created for it.
+#
+REPLY_PREFIX = "/reply/"
+
 class RadiatorTimeout(Exception):
 
     pass
 
+class RadiatorQueueFull(Exception):
+
+    pass
+
+# an ERROR frame from the broker, seen by a client
+class RadiatorError(IOError):
+
+    pass
+
+#
+# Batches fsyncs across all queues of a broker.  Queues mark themselves
+# dirty instead of fsyncing inline, and callers that need durability
+# (e.g. SEND receipts) register a callback with defer().  commit() runs
+# at most once per window: one fsync per dirty queue covers every write
+# made since the last commit, then the deferred callbacks are released.
+#
+class GroupCommit(object):
+
+    def __init__(self, window_millis=0):
+        self.window_secs = window_millis / 1000.0
+        self.next_commit = 0
+        self.commits = 0
+        #
+        #   key: dest_name
+        # value: FileQueue with unsynced writes
+        self.dirty   = { }
+        self.waiters = [ ]
+
+    def mark_dirty(self, queue):
+        self.dirty[queue.name] = queue
+
+    def defer(self, callback):
+        if self.dirty:
+            self.waiters.append(callback)
+        else:
+            callback()
+
+    def commit(self, force=False):
+        now = time.time()
+        if not force and now < self.next_commit:
+            return False
+        self.next_commit = now + self.window_secs
+        if not self.dirty and not self.waiters:
+            return False
+        dirty = self.dirty.values()
+        self.dirty = { }
+        for queue in dirty:
+            queue.sync()
+        waiters = self.waiters
+        self.waiters = [ ]
+        for callback in waiters:
+            try:
+                callback()
+            except Exception, e:
+                logger.error("group commit callback failed: %s" % e)
+        self.commits += 1
+        return True
+
+#
+# Runs jobs on a background thread so blocking file I/O doesn't stall
+# the reactor.  Results are handed back to the callbacks on the reactor
+# thread when poll() is called (see Broker.tick()).
+#
+class BackgroundWorker(object):
+
+    def __init__(self):
+        self.jobs = Queue.Queue()
+        self.done = deque()
+        self.thread = None
+
+    def submit(self, fn, args, callback):
+        if not self.thread:
+            self.thread = threading.Thread(target=self._run,
+                                           name="radiator-worker")
+            self.thread.daemon = True
+            self.thread.start()
+        self.jobs.put((fn, args, callback))
+
+    def poll(self):
+        while self.done:
+            (callback, result, error) = self.done.popleft()
+            callback(result, error)
+
+    def _run(self):
+        while True:
+            (fn, args, callback) = self.jobs.get()
+            try:
+                self.done.append((callback, fn(*args), None))
+            except Exception, e:
+                self.done.append((callback, None, e))
+
+#
+# Destination names are split into segments on "." for wildcard
+# matching.  In a subscription "*" matches exactly one segment and a
+# trailing ">" matches one or more, e.g. /topic/logs.* matches
+# /topic/logs.email and /topic/logs.> also matches /topic/logs.email.smtp
+#
+def topic_matches(pattern, dest_name):
+    pattern = pattern.split(".")
+    segs = dest_name.split(".")
+    for i in range(len(pattern)):
+        if pattern[i] == ">" and i == len(pattern) - 1:
+            return len(segs) > i
+        if i >= len(segs) or (pattern[i] != "*" and pattern[i] != segs[i]):
+            return False
+    return len(segs) == len(pattern)
+
+class TopicNode(object):
+
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children = { }
+        self.values   = { }
+
+#
+# Trie keyed on destination name segments.  The broker keeps one of
+# subscriptions (patterns, may contain wildcards) and one of destinations
+# (plain names) so that creating a destination or subscribing only
+# visits the subscriptions / destinations that match.
+#
+class TopicTree(object):
+
+    def __init__(self):
+        self.root = TopicNode()
+
+    def add(self, name, key, value):
+        node = self.root
+        for seg in name.split("."):
+            child = node.children.get(seg)
+            if not child:
+                child = node.children[seg] = TopicNode()
+            node = child
+        node.values[key] = value
+
+    def remove(self, name, key):
+        path = [ ]
+        node = self.root
+        for seg in name.split("."):
+            path.append((node, seg))
+            node = node.children.get(seg)
+            if not node:
+                return
+        if node.values.has_key(key):
+            del(node.values[key])
+        # prune nodes left empty
+        for (parent, seg) in reversed(path):
+            child = parent.children[seg]
+            if child.values or child.children:
+                break
+            del(parent.children[seg])
+
+    def match(self, dest_name):
+        # values stored under patterns matching dest_name
+        found = [ ]
+        self._match(self.root, dest_name.split("."), 0, found)
+        return found
+
+    def find(self, pattern):
+        # values stored under names matching pattern
+        found = [ ]
+        self._find(self.root, pattern.split("."), 0, found)
+        return found
+
+    def _match(self, node, segs, i, found):
+        if i == len(segs):
+            found.extend(node.values.values())
+            return
+        children = node.children
+        if children.has_key(segs[i]):
+            self._match(children[segs[i]], segs, i + 1, found)
+        if children.has_key("*"):
+            self._match(children["*"], segs, i + 1, found)
+        if children.has_key(">"):
+            found.extend(children[">"].values.values())
+
+    def _find(self, node, segs, i, found):
+        if i == len(segs):
+            found.extend(node.values.values())
+            return
+        seg = segs[i]
+        if seg == ">" and i == len(segs) - 1:
+            for child in node.children.values():
+                self._find_all(child, found)
+        elif seg == "*":
+            for child in node.children.values():
+                self._find(child, segs, i + 1, found)
+        elif node.children.has_key(seg):
+            self._find(node.children[seg], segs, i + 1, found)
+
+    def _find_all(self, node, found):
+        found.extend(node.values.values())
+        for child in node.children.values():
+            self._find_all(child, found)
+
 class Subscription(object):
 
     def __init__(self, dest_name, auto_ack, dest, wildcard_add=False):
@@ -36,30 +260,56 @@ class Subscription(object):
         self.wildcard_add = wildcard_add
 
     def matches(self, dest_name):
-        if self.dest_name.endswith(".>"):
-            s = self.dest_name[:dest_name.rfind(".>")]
-            return dest_name.startswith(s)
+        return topic_matches(self.dest_name, dest_name)
 
 class Session(object):
 
-    def __init__(self, session_id, send_message_cb):
+    def __init__(self, session_id, send_message_cb, prefetch_count=1):
         self.session_id       = session_id
         self.send_message_cb  = send_message_cb
         self.subscriptions = { }
-        self.busy = False
+        #
+        # client ack messages sent but not acked yet, across all of the
+        # session's subscriptions.  no more are sent while the window
+        # of prefetch_count messages is full.  when the session ends
+        # they go straight back to their destinations.
+        #
+        #   key: message id (UUID), oldest first
+        # value: (Dest obj, delivery number, see Message)
+        self.in_flight = OrderedDict()
+        self.prefetch_count = prefetch_count
+        #
+        # subscriptions whose destination may have pending messages, in
+        # round robin order.  a destination adds itself when it takes
+        # this session off its ready set for lack of room (see
+        # BaseDestination.dispatch), so the session pulls from it once
+        # an ack makes room.  it's dropped once found empty, and the
+        # session goes back on its ready set.
+        #
+        #   key: dest_name
+        # value: Subscription obj
+        self.nonempty = OrderedDict()
 
     def destroy(self):
         for dest_name, sub in self.subscriptions.items():
             if sub.dest:
                 sub.dest.unsubscribe(self)
         self.subscriptions.clear()
+        self.nonempty.clear()
+        # unsubscribed first so the messages go to other sessions
+        in_flight = self.in_flight
+        self.in_flight = OrderedDict()
+        for id, (dest, delivery) in in_flight.items():
+            dest.requeue(id, delivery)
 
     def subscribe(self, dest_name, auto_ack, dest=None, wildcard_add=False):
         sub = Subscription(dest_name, auto_ack, dest, wildcard_add)
         self.subscriptions[dest_name] = sub
         if dest:
             dest.subscribe(self)
-            self.pull_message(dest)
+            self.fill(dest)
+            if dest.pending_messages() > 0:
+                self.nonempty[dest_name] = sub
 
     def unsubscribe(self, dest_name):
         if self.subscriptions.has_key(dest_name):
@@ -67,65 +317,140 @@ class Session(object):
             if d.dest:
                 d.dest.unsubscribe(self)
             del(self.subscriptions[dest_name])
+            if self.nonempty.has_key(dest_name):
+                del(self.nonempty[dest_name])
             # TODO - remove wildcard matches
 
-    def add_all_matching_dests(self, dest_dict):
-        for dest in dest_dict.values():
-            self.on_dest_created(dest)
-
-    def on_dest_created(self, dest):
-        if self.subscriptions.has_key(dest.name):
-            d = self.subscriptions[dest.name]
+    def on_dest_created(self, dest, pattern):
+        # pattern is the subscription that matched dest (see
+        # Broker.subscription_tree)
+        if not self.subscriptions.has_key(pattern):
+            return
+        if pattern == dest.name:
+            d = self.subscriptions[pattern]
             if d.dest != dest:
                 d.dest = dest
                 dest.subscribe(self)
-        else:
-            parent_sub = None
-            for sub in self.subscriptions.values():
-                if sub.matches(dest.name):
-                    parent_sub = sub
-                    break
-            if parent_sub:
-                self.subscribe(dest.name, parent_sub.auto_ack, dest,
-                               wildcard_add=True)
+        elif not self.subscriptions.has_key(dest.name):
+            parent_sub = self.subscriptions[pattern]
+            self.subscribe(dest.name, parent_sub.auto_ack, dest,
+                           wildcard_add=True)
+
+    def fill(self, dest=None):
+        # pull until the prefetch window is full.  auto ack messages
+        # don't take a slot, so at most one of those is pulled.
+        while True:
+            unacked = len(self.in_flight)
+            if not self.pull_message(dest) or \
+                   len(self.in_flight) == unacked:
+                break
+
+    def on_ack(self, id):
+        if self.in_flight.has_key(id):
+            del(self.in_flight[id])
+        self.fill()
+
+    def on_not_ready(self, dest):
+        if self.subscriptions.has_key(dest.name):
+            self.nonempty[dest.name] = self.subscriptions[dest.name]
+
+    def has_room(self):
+        return len(self.in_flight) < self.prefetch_count
+
+    def set_prefetch_count(self, prefetch_count):
+        # a larger window has room for messages held back so far, same
+        # as after an ack
+        grew = prefetch_count > self.prefetch_count
+        self.prefetch_count = prefetch_count
+        if grew:
+            self.fill()
 
     def pull_message(self, dest=None):
         msg_sent = False
-        if not self.busy:
+        if self.has_room():
             msg = None
             auto_ack = True
             if dest:
                 auto_ack = self.subscriptions[dest.name].auto_ack
                 msg = dest.receive(auto_ack)
             else:
-                my_dests = self.subscriptions.values()
-                random.shuffle(my_dests)
-                for d in my_dests:
+                nonempty = self.nonempty
+                while nonempty:
+                    (dest_name, d) = nonempty.popitem(last=False)
                     if d.dest:
-                        msg = d.dest.receive(d.auto_ack)
+                        auto_ack = d.auto_ack
+                        msg = d.dest.receive(auto_ack)
                         if msg:
+                            # back of the line, it may have more
+                            nonempty[dest_name] = d
                             break
+                        # new messages are offered by dispatch() again
+                        d.dest.on_ready(self)
             if msg:
-                self.busy = (not auto_ack)
+                if not auto_ack:
+                    self.in_flight[msg[1].id] = (msg[0], msg[1].delivery)
                 msg_sent  = True
                 dest_name = msg[0].name
                 msg_id    = msg[1].id.hex+","+msg[0].name
-                body      = msg[1].body
-                self.send_message_cb(dest_name, msg_id, body)
+                self.send_message(dest_name, msg_id, msg[1].body,
+                                  msg[1].headers)
         return msg_sent
 
-    def send_message(self, dest_name, msg_id, body):
-        self.send_message_cb(dest_name, msg_id, body)
+    def send_message(self, dest_name, msg_id, body, headers=""):
+        # callbacks that don't care about headers take three arguments
+        if headers:
+            self.send_message_cb(dest_name, msg_id, body, headers)
+        else:
+            self.send_message_cb(dest_name, msg_id, body)
 
 class Broker(object):
 
+    # how often the reactor should call tick()
+    tick_interval_secs = 0.005
+    # how often tick() requeues messages whose ack timeout expired
+    expire_interval_secs = 1.0
+    # how long a reply-to destination waits for its reply, unless the
+    # request has an expires header
+    reply_timeout_secs = 60.0
+
     def __init__(self, dir=None,
                  fsync_millis=0,
-                 rewrite_interval_secs=300):
+                 rewrite_interval_secs=300,
+                 group_commit=False,
+                 prefetch_count=1,
+                 memory_queue_max_size=100000,
+                 compress_files=False):
         self.dir = dir
         self.fsync_millis = fsync_millis
         self.rewrite_interval_secs = rewrite_interval_secs
         #
+        # if group_commit is enabled, queue writes are fsynced in
+        # batches by tick() every fsync_millis instead of inline
+        self.committer = None
+        if group_commit:
+            self.committer = GroupCommit(fsync_millis)
+        self.worker = BackgroundWorker()
+        #
+        # offload(fn, *args) runs fn on another thread and returns its
+        # result without blocking other clients.  set by reactors that
+        # support it, used to compress large message bodies.
+        self.offload = None
+        self.compress_files = compress_files
+        self.next_expire = 0
+        # unacked messages a session may hold unless SUBSCRIBE says
+        # otherwise
+        self.prefetch_count = prefetch_count
+        # most messages a /memqueue/ destination holds before SENDs
+        # to it fail
+        self.memory_queue_max_size = memory_queue_max_size
+        #
+        # for the protocol layer while a message is delivered to many
+        # sessions, e.g. a topic MESSAGE frame encoded once for all
+        # subscribers.  emptied after each send so no body is kept.
+        #
+        #   key: message id (hex)
+        self.fanout_cache = { }
+        #
         #   key: dest_name
         # value: Dest obj (provides send(), receive(), ack())
         self.dest_dict        = { }
@@ -133,39 +458,135 @@ class Broker(object):
         #   key: session_id
         # value: Session obj
         self.session_dict     = { }
+        #
+        # subscriptions by destination name / pattern
+        #   value: (session, pattern)
+        self.subscription_tree = TopicTree()
+        #
+        # destinations by name
+        #   value: Dest obj
+        self.dest_tree = TopicTree()
+        #
+        # reply-to destinations waiting for their reply
+        #   key: reply-to dest_name
+        # value: (send_message_cb, expire time in millis)
+        self.replies = { }
+        # (expire time in millis, dest_name) per entry in replies
+        self.reply_expiry = [ ]
 
     def destroy_session(self, session_id):
         if self.session_dict.has_key(session_id):
-            self.session_dict[session_id].destroy()
+            session = self.session_dict[session_id]
+            for dest_name in session.subscriptions.keys():
+                self.subscription_tree.remove(dest_name, session_id)
+            session.destroy()
             del self.session_dict[session_id]
 
-    def send(self, dest_name, body):
-        self._get_or_create_dest(dest_name).send(body)
+    def send(self, dest_name, body, on_commit=None, headers=""):
+        self.send_many(dest_name, [ body ], on_commit, [ headers ])
 
-    def subscribe(self, dest_name, auto_ack, session_id, on_message_cb):
+    def send_many(self, dest_name, bodies, on_commit=None, headers=None):
+        # on_commit is called once, after all the bodies are committed.
+        # headers, if given, has the headers for each body
+        if dest_name.startswith(REPLY_PREFIX):
+            self._send_replies(dest_name, bodies, headers)
+        else:
+            self._get_or_create_dest(dest_name).send_many(bodies, headers)
+        if self.fanout_cache:
+            self.fanout_cache.clear()
+        if on_commit:
+            if self.committer:
+                self.committer.defer(on_commit)
+            else:
+                on_commit()
+
+    def expect_reply(self, reply_to, send_message_cb, expires=None):
+        # the next message sent to reply_to is given to send_message_cb
+        # (see Session.send_message), unless it comes after expires
+        # (millis since the epoch)
+        if not expires:
+            expires = now_millis() + int(self.reply_timeout_secs * 1000)
+        self.replies[reply_to] = (send_message_cb, expires)
+        heapq.heappush(self.reply_expiry, (expires, reply_to))
+
+    def tick(self):
+        self.worker.poll()
+        if self.committer:
+            self.committer.commit()
+        if self.reply_expiry:
+            self._expire_replies(now_millis())
+        now = time.time()
+        if now >= self.next_expire:
+            self.next_expire = now + self.expire_interval_secs
+            now_ms = now_millis()
+            for dest in self.dest_dict.values():
+                dest.requeue_expired(now_ms)
+
+    def subscribe(self, dest_name, auto_ack, session_id, on_message_cb,
+                  prefetch_count=None):
         session = self._get_or_create_session(session_id, on_message_cb)
+        if prefetch_count:
+            session.set_prefetch_count(prefetch_count)
         dest = None
         if self.dest_dict.has_key(dest_name):
             dest = self.dest_dict[dest_name]
         session.subscribe(dest_name, auto_ack, dest=dest)
-        session.add_all_matching_dests(self.dest_dict)
+        self.subscription_tree.add(dest_name, session_id,
+                                   (session, dest_name))
+        if dest_name.find("*") >= 0 or dest_name.endswith(".>"):
+            for dest in self.dest_tree.find(dest_name):
+                session.on_dest_created(dest, dest_name)
 
     def unsubscribe(self, dest_name, session_id):
         if self.session_dict.has_key(session_id):
             session = self.session_dict[session_id]
             session.unsubscribe(dest_name)
+            self.subscription_tree.remove(dest_name, session_id)
 
     def ack(self, session_id, message_id):
-        (message_id, dest_name) = message_id.split(",")
-        self._get_or_create_dest(dest_name).ack(uuid.UUID(message_id))
+        # message ids are "<uuid hex>,<dest_name>", see Session
+        try:
+            (uid, dest_name) = message_id.split(",", 1)
+            id = uuid.UUID(uid)
+        except ValueError:
+            logger.error("ack: invalid message id: %s" % message_id)
+            return
+        if dest_name.startswith(REPLY_PREFIX):
+            # replies aren't kept, so there's nothing to ack
+            return
+        if not self.dest_dict.has_key(dest_name):
+            logger.error("ack: no destination: %s" % dest_name)
+            return
+        self.dest_dict[dest_name].ack(id)
         if self.session_dict.has_key(session_id):
-            session = self.session_dict[session_id]
-            session.busy = False
-            session.pull_message()
+            self.session_dict[session_id].on_ack(id)
+
+    def _send_replies(self, dest_name, bodies, headers):
+        # dropped if nobody is waiting, e.g. the caller timed out
+        (send_message_cb, expires) = self.replies.pop(dest_name, (None, 0))
+        if not send_message_cb:
+            return
+        headers = headers or [ "" ] * len(bodies)
+        for (body, h) in zip(bodies, headers):
+            msg_id = uuid.uuid4().hex + "," + dest_name
+            if h:
+                send_message_cb(dest_name, msg_id, body, h)
+            else:
+                send_message_cb(dest_name, msg_id, body)
+
+    def _expire_replies(self, now_ms):
+        expiry = self.reply_expiry
+        while expiry and expiry[0][0] <= now_ms:
+            (expires, dest_name) = heapq.heappop(expiry)
+            # skip entries already replied to, or registered again
+            entry = self.replies.get(dest_name)
+            if entry and entry[1] == expires:
+                del self.replies[dest_name]
 
     def _get_or_create_session(self, session_id, on_message_cb):
         if not self.session_dict.has_key(session_id):
-            self.session_dict[session_id] = Session(session_id, on_message_cb)
+            self.session_dict[session_id] = Session(session_id, on_message_cb,
+                                                    self.prefetch_count)
         return self.session_dict[session_id]
 
     def _get_or_create_dest(self, dest_name):
@@ -176,59 +597,176 @@ class Broker(object):
         else: 
             if dest_name.find("/topic/") == 0:
                 dest = PubSubTopic(dest_name)
+            elif dest_name.find("/memqueue/") == 0:
+                dest = MemoryQueue(dest_name,
+                                   max_size=self.memory_queue_max_size)
             else:
                 rw_secs = self.rewrite_interval_secs
                 dest = FileQueue(dest_name,
                                  dir=self.dir,
                                  rewrite_interval_secs=rw_secs,
-                                 fsync_millis=self.fsync_millis)
+                                 fsync_millis=self.fsync_millis,
+                                 committer=self.committer,
+                                 worker=self.worker,
+                                 compress_files=self.compress_files,
+                                 offload=self.offload)
             dests[dest_name] = dest
-            for session in self.session_dict.values():
-                session.on_dest_created(dest)
+            self.dest_tree.add(dest_name, dest_name, dest)
+            for (session, pattern) in self.subscription_tree.match(dest_name):
+                session.on_dest_created(dest, pattern)
         return dest
 
+#
+# Segment files start with a magic string and the file format version.
+# Version 1 was a single .msg.dat file per queue with the pending
+# file position and version in its first 12 bytes.
+#
+SEGMENT_MAGIC = "RSEG"
+SEGMENT_HEADER_SIZE = 8
+LEGACY_HEADER_SIZE = 12
+#
+# Index files hold a checkpoint of a queue's in memory state:
+#   magic, version, read_seq, pending_file_pos, write_seq, write_pos,
+#   pending_message_count, segment count, in use count
+# followed by (seq, live count, live bytes, size) per segment, then
+# (seq, pos) and the 48 byte message header per in use message, then a
+# crc32 of all of the above.
+#
+INDEX_MAGIC = "RIDX"
+INDEX_VERSION = 1
+INDEX_HEADER = "4siqqqqqii"
+INDEX_SEGMENT = "qqqq"
+INDEX_IN_USE = "qq"
+
+#
+# Every message record starts with a 48 byte header:
+#   create time, dequeue time, ack timeout, message id (16 bytes),
+#   record flags (top 8 bits) | extra header size, body size
+# followed by the extra headers ("name:value" lines, see Message) and
+# the body.  dequeue time and ack timeout are updated in place
+# (TIMEOUTS_CODEC at offset 8) as the message is received and acked.
+# A dequeued message is in use while its ack timeout is > 0, acked
+# once it is 0 and pending again (ahead of the read position) once it
+# is -1, i.e. it expired unacked.
+# The body of a record flagged COMPRESSED is zlib compressed, and body
+# size is its compressed size.
+#
+HEADER_CODEC   = struct.Struct("qqq16sii")
+HEADER_SIZE_MASK = 0xffffff
+FLAGS_SHIFT = 24
+COMPRESSED  = 1
+TIMEOUTS_CODEC = struct.Struct("qq")
+ACKED    = struct.pack("q", 0)
+REQUEUED = struct.pack("q", -1)
+
+def uuid_bytes(id):
+    # UUID.bytes builds the string a byte at a time, this is much faster
+    return id.hex.decode("hex")
+
+class Message(object):
+
+    __slots__ = ("id", "body", "headers", "delivery")
+
+    def __init__(self, id, body, headers="", delivery=0):
+        self.id   = id
+        self.body = body
+        # "name:value" lines given to SEND and passed on to subscribers,
+        # e.g. reply-to
+        self.headers = headers
+        # set by receive() with client ack.  numbers the deliveries of
+        # the destination: a message that expired and was received
+        # again has a new one.
+        self.delivery = delivery
+
 class MessageHeader(object):
 
+    __slots__ = ("seg", "pos", "create_time", "dequeue_time", "ack_timeout",
+                 "uid", "header_size", "body_size", "flags", "delivery")
+
     def __init__(self, pos, create_time, dequeue_time, ack_timeout,
-                 id, header_size, body_size):
+                 id, header_size, body_size, seg=0, flags=0):
+        self.seg = seg
         self.pos = pos
         self.create_time  = create_time
         self.dequeue_time = dequeue_time
         self.ack_timeout  = ack_timeout
-        self.id = id
+        # raw 16 byte id. much smaller than a UUID object
+        self.uid = uuid_bytes(id)
         self.header_size = header_size
         self.body_size   = body_size
-        self.total_size  = header_size + body_size + 48
+        self.flags = flags
+        # in memory only, see Message
+        self.delivery = 0
+
+    @property
+    def id(self):
+        return uuid.UUID(hex=self.uid.encode("hex"))
 
-    def copy(self, from_file, to_file):
-        self._write_header(to_file)
+    @property
+    def total_size(self):
+        return self.header_size + self.body_size + 48
+
+    def copy(self, from_file, to_file, to_pos=None):
+        # read first, from_file and to_file may be the same file
         from_file.seek(self.pos+48)
-        if (self.header_size > 0):
-            to_file.write(from_file.read(self.header_size))
-        if (self.body_size > 0):
-            to_file.write(from_file.read(self.body_size))
+        data = from_file.read(self.header_size + self.body_size)
+        if to_pos is not None:
+            to_file.seek(to_pos)
+        to_file.write(self.encode() + data)
 
     def write(self, to_file, header, body):
         self.header_size = len(header)
         self.body_size   = len(body)
-        self._write_header(to_file)
-        to_file.write(header)
-        to_file.write(body)
-
-    def _write_header(self, to_file):
-        to_file.write(struct.pack("q", self.create_time))
-        to_file.write(struct.pack("q", self.dequeue_time))
-        to_file.write(struct.pack("q", self.ack_timeout))
-        to_file.write(self.id.bytes)
-        to_file.write(struct.pack("i", self.header_size))
-        to_file.write(struct.pack("i", self.body_size))
+        to_file.write("".join((self.encode(), header, body)))
+
+    def encode(self):
+        return HEADER_CODEC.pack(self.create_time, self.dequeue_time,
+                                 self.ack_timeout, self.uid,
+                                 self.flags << FLAGS_SHIFT | self.header_size,
+                                 self.body_size)
 
     def __str__(self):
         #return "MessageHeader pos=%d id=%s create_time=%d dequeue_time=%d " + \
         #       "ack_timeout=%d header_size=%d body_size=%d" % \
         #(self.pos, self.id.hex, self.create_time, self.dequeue_time,
         #        self.ack_timeout, self.header_size, self.body_size)
-        return "MessageHeader pos=%s id=%s" % (self.pos, self.id.hex)
+        return "MessageHeader seg=%s pos=%s id=%s" % \
+               (self.seg, self.pos, self.id.hex)
+
+def decode_header(data, pos, seg=0):
+    msg = MessageHeader.__new__(MessageHeader)
+    (msg.create_time, msg.dequeue_time, msg.ack_timeout, msg.uid,
+     header_size, msg.body_size) = HEADER_CODEC.unpack(data)
+    msg.header_size = header_size & HEADER_SIZE_MASK
+    msg.flags = header_size >> FLAGS_SHIFT
+    msg.pos = pos
+    msg.seg = seg
+    msg.delivery = 0
+    return msg
+
+def compact_segment(path, records):
+    # copy the given (id, pos, size) records of a segment into a
+    # temp file. runs on the BackgroundWorker thread, so it must not
+    # touch any queue state
+    start = time.time()
+    src = open(path, "rb")
+    (tmp_fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path))
+    dst = os.fdopen(tmp_fd, "wb")
+    dst.write(src.read(SEGMENT_HEADER_SIZE))
+    moved = [ ]
+    for (uid, pos, size) in records:
+        src.seek(pos)
+        moved.append((uid, pos, dst.tell()))
+        dst.write(src.read(size))
+    src.close()
+    dst.flush()
+    os.fsync(dst.fileno())
+    dst.close()
+    return (tmp_path, moved, time.time() - start)
+
+def read_msg(f, pos, seg=0):
+    f.seek(pos, 0)
+    return decode_header(f.read(48), pos, seg)
 
 class BaseDestination(object):
 
@@ -236,21 +774,83 @@ class BaseDestination(object):
         #self._validate_name(name)
         self.name = name
         self.subscribers = { }
+        #
+        # subscribers that may have room for another message, longest
+        # waiting first.  sessions are added when they subscribe or ack
+        # and taken off when a message fills their prefetch window, so
+        # dispatch doesn't scan subscribers that are busy.
+        #
+        #   key: session_id
+        # value: Session obj
+        self.ready = OrderedDict()
+        # numbers client ack receives, see Message
+        self.deliveries = 0
 
     def subscribe(self, session):
         if not self.subscribers.has_key(session.session_id):
             self.subscribers[session.session_id] = session
+            self.ready[session.session_id] = session
 
     def unsubscribe(self, session):
         if self.subscribers.has_key(session.session_id):
             del(self.subscribers[session.session_id])
-        
-    def send(self, body):
+        if self.ready.has_key(session.session_id):
+            del(self.ready[session.session_id])
+
+    def on_ready(self, session):
+        if self.subscribers.has_key(session.session_id):
+            self.ready[session.session_id] = session
+
+    def dispatch(self):
+        # offer a message to the longest waiting ready session.  it goes
+        # to the back of the line if it still has room afterwards.  a
+        # session without room is taken off, and pulls from here once it
+        # has room (see Session.on_not_ready), so sends to a queue whose
+        # subscribers are all busy don't touch them.
+        ready = self.ready
+        while ready:
+            (session_id, session) = ready.popitem(last=False)
+            if not session.has_room():
+                session.on_not_ready(self)
+            elif session.pull_message(self):
+                if session.has_room():
+                    ready[session_id] = session
+                else:
+                    session.on_not_ready(self)
+                return True
+            else:
+                # nothing could be received
+                ready[session_id] = session
+                return False
+        return False
+
+    def wake_subscribers(self):
+        # messages were sent or requeued: hand them to ready sessions
+        while self.pending_messages() > 0 and self.dispatch():
+            pass
+
+    def send(self, body, headers=""):
         raise NotImplementedError
 
+    def send_many(self, bodies, headers=None):
+        headers = headers or [ "" ] * len(bodies)
+        return [ self.send(body, h) for (body, h) in zip(bodies, headers) ]
+
     def receive(self, auto_ack):
         raise NotImplementedError
 
+    def pending_messages(self):
+        raise NotImplementedError
+
+    def requeue_expired(self, now_ms):
+        raise NotImplementedError
+
+    def requeue(self, id, delivery):
+        # in use message whose session ended.  a no-op unless it's still
+        # in use by that delivery, i.e. it hasn't expired and gone to
+        # another session since
+        raise NotImplementedError
+
     def ack(self, id):
         raise NotImplementedError
 
@@ -275,56 +875,260 @@ class PubSubTopic(BaseDestination):
         BaseDestination.__init__(self, name)
         self.messages = [ ]
 
-    def send(self, body):
+    def send(self, body, headers=""):
         id = uuid.uuid4()
         for k, v in self.subscribers.items():
-            v.send_message(self.name, id.hex, body)
+            v.send_message(self.name, id.hex, body, headers)
 
     def receive(self, auto_ack):
         return None
 
+    def pending_messages(self):
+        return 0
+
+    def requeue_expired(self, now_ms):
+        pass
+
+    def requeue(self, id, delivery):
+        pass
+
     def ack(self, id):
         pass
 
     def close():
         pass
 
+#
+# Queue that lives only in memory, for work that can be lost on restart.
+# Same ack semantics as FileQueue: messages received with client ack are
+# in use until acked, and requeued at the head if not acked within
+# ack_timeout.  Holds at most max_size pending + in use messages; send()
+# raises RadiatorQueueFull beyond that.
+#
+class MemoryQueue(BaseDestination):
+
+    def __init__(self, name, ack_timeout=120, max_size=100000):
+        BaseDestination.__init__(self, name)
+        self.ack_timeout_millis = int(ack_timeout * 1000)
+        self.max_size = max_size
+        # Message objs, oldest first
+        self.pending = deque()
+        #
+        #   key: message id (UUID)
+        # value: (Message, ack timeout in millis, delivery)
+        self.msgs_in_use = { }
+        # heap of (ack timeout, message id).  entries for messages acked
+        # meanwhile are skipped when popped.
+        self.deadlines = [ ]
+
+    def pending_messages(self):
+        return len(self.pending)
+
+    def in_use_messages(self):
+        return len(self.msgs_in_use)
+
+    def msg_in_use(self, id):
+        return self.msgs_in_use.has_key(id)
+
+    def stats(self):
+        return { "pending" : len(self.pending),
+                 "in_use"  : len(self.msgs_in_use) }
+
+    def send(self, body, headers=""):
+        return self.send_many([ body ], [ headers ])[0]
+
+    def send_many(self, bodies, headers=None):
+        # all or nothing
+        if len(self.pending) + len(self.msgs_in_use) + len(bodies) > \
+               self.max_size:
+            raise RadiatorQueueFull("Queue %s is full (max_size=%d)" %
+                                    (self.name, self.max_size))
+        headers = headers or [ "" ] * len(bodies)
+        ids = [ ]
+        for (body, h) in zip(bodies, headers):
+            id = uuid.uuid4()
+            self.pending.append(Message(id, body, h))
+            ids.append(id)
+        self.wake_subscribers()
+        return ids
+
+    def receive(self, auto_ack):
+        if not self.pending:
+            return None
+        msg = self.pending.popleft()
+        if not auto_ack:
+            ack_timeout = now_millis() + self.ack_timeout_millis
+            self.deliveries += 1
+            msg.delivery = self.deliveries
+            self.msgs_in_use[msg.id] = (msg, ack_timeout, msg.delivery)
+            heapq.heappush(self.deadlines, (ack_timeout, msg.id))
+            if len(self.deadlines) > 2 * len(self.msgs_in_use) + 1024:
+                self.deadlines = [ (t, m.id) for (m, t, d) in
+                                   self.msgs_in_use.values() ]
+                heapq.heapify(self.deadlines)
+        return (self, msg)
+
+    def ack(self, id):
+        if self.msgs_in_use.has_key(id):
+            del(self.msgs_in_use[id])
+        else:
+            logger.error("ack: %s: no msg in use with id: %s" % \
+                         (self.name, id.hex))
+
+    def close(self):
+        pass
+
+    def destroy(self):
+        BaseDestination.destroy(self)
+        self.pending.clear()
+        self.msgs_in_use.clear()
+        self.deadlines = [ ]
+
+    def requeue_expired(self, now_ms):
+        deadlines = self.deadlines
+        expired = [ ]
+        while deadlines and deadlines[0][0] < now_ms:
+            (ack_timeout, id) = heapq.heappop(deadlines)
+            entry = self.msgs_in_use.get(id)
+            if entry and entry[1] == ack_timeout:
+                del(self.msgs_in_use[id])
+                expired.append(entry[0])
+        if expired:
+            expired.reverse()
+            self.pending.extendleft(expired)
+            self.wake_subscribers()
+
+    def requeue(self, id, delivery):
+        # in use message whose session ended - back to the head
+        entry = self.msgs_in_use.get(id)
+        if entry and entry[2] == delivery:
+            self.pending.appendleft(self.msgs_in_use.pop(id)[0])
+            self.wake_subscribers()
+
 class FileQueue(BaseDestination):
 
     def __init__(self, name, dir=None, ack_timeout=120, fsync_millis=0,
                  rewrite_interval_secs=300,
-                 compress_files=False):
+                 compress_files=False,
+                 committer=None,
+                 segment_size=16*1024*1024,
+                 checkpoint_interval_secs=60,
+                 worker=None,
+                 body_cache_bytes=4*1024*1024,
+                 compress_min_bytes=1024,
+                 offload=None,
+                 offload_min_bytes=64*1024):
         BaseDestination.__init__(self, name)
-        self.version = 1
+        self.version = 2
+        #
+        # if compress_files is set, bodies of at least compress_min_bytes
+        # are stored zlib compressed.  bodies of at least
+        # offload_min_bytes are compressed by offload(fn, *args), which
+        # runs fn on another thread without blocking other clients.
+        # decompression is always inline: receive() can't let anything
+        # else touch the queue half way through.
         self.compress_files = compress_files
+        self.compress_min_bytes = compress_min_bytes
+        self.offload = offload
+        self.offload_min_bytes = offload_min_bytes
         dir = dir or os.getcwd()
         self.dir = dir
+        #
+        # no longer used: expired messages are requeued by
+        # Broker.tick() and sparse segments compacted on ack
         self.rewrite_interval_secs = rewrite_interval_secs
-        self.next_rewrite = 0
+        #
+        # segments that are left holding only a few long running in use
+        # messages are compacted by the BackgroundWorker. if no worker
+        # is given compaction runs inline
+        self.worker = worker
+        # segments where less than 10% of the messages are still in use
+        self.sparse = set()
+        self.compacting = set()
+        self.compactions = 0
+        self.compaction_secs = 0.0
+        self.bytes_reclaimed = 0
         self.ack_timeout_millis = int(ack_timeout * 1000)
-        self.pending_prune_threshold = 10 * 1024 * 1024
         # dict tracking messages in use
-        #   key: uuid of message
-        #   value: tuple (starting byte offset in file, timeout)
+        #   key: hex uuid of message
+        #   value: MessageHeader (segment, byte offset in segment, timeout)
         self.msgs_in_use = { }
+        #
+        # messages whose ack timeout expired.  they are pending again
+        # and received before the message at the read position.
+        #   key: raw message id
+        #   value: MessageHeader
+        self.requeued = OrderedDict()
+        # heap of (ack timeout, raw message id) for msgs_in_use.
+        # entries for messages acked meanwhile are skipped when popped.
+        self.deadlines = [ ]
+        # pending messages, including requeued ones
         self.pending_message_count = 0
-        self.total_messages = 0
         #
-        # pending_file_pos is a byte offset into the
-        # pending file. we increment this as we read
-        # if we hit EOF then we have an empty queue and
-        # can reset the queue file
-        self.pending_file_pos = 12
+        # messages are appended to a series of segment files. once the
+        # last segment reaches segment_size a new one is started.  a
+        # segment with no pending or in use messages left is unlinked,
+        # so reclaiming disk never requires copying messages.
+        #
+        #   key: segment number
+        # value: number of pending + in use messages in the segment
+        self.segment_size = segment_size
+        self.segments = { }
+        #
+        #   key: segment number
+        # value: bytes used by pending + in use messages in the segment
+        self.segment_live_bytes = { }
+        #
+        #   key: segment number (sealed segments only)
+        # value: size of segment file in bytes
+        self.segment_ends = { }
+        self.seg_files = { }
+        # read only maps of segment files, for reads that miss the
+        # body cache.  closed along with the segment file.
+        self.seg_maps = { }
+        #
+        # bodies of recently sent messages.  most messages are received
+        # soon after they're sent, so receive() rarely touches the disk.
+        # bounded by body_cache_bytes, oldest evicted first.
+        #
+        #   key: (segment number, pos)
+        # value: (MessageHeader, body, headers)
+        self.body_cache = OrderedDict()
+        self.body_cache_bytes = 0
+        self.body_cache_max_bytes = body_cache_bytes
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.write_seq = 1
+        self.write_pos = SEGMENT_HEADER_SIZE
+        #
+        # read_seq and pending_file_pos point at the next pending message.
+        # everything before it has been dequeued, everything from it to
+        # the end of the last segment is pending.
+        self.read_seq = 1
+        self.pending_file_pos = SEGMENT_HEADER_SIZE
         #
         # each queue has a configurable fsync interval
         # fsync_seconds==0 means we'll fsync on all writes
-        self.fsync_seconds = now_millis()
+        # unless a GroupCommit is given, which batches fsyncs
+        # across queues
+        self.fsync_seconds = fsync_millis / 1000.0
         self.last_fsync = 0
+        self.committer = committer
+        self.unsynced = set()
+        #
+        # segment files are named <basename>.<segment number>.seg
+        self.basename = base64.urlsafe_b64encode(name)
+        # single file format used prior to segments. migrated on load
+        self.filename = os.path.join(dir, "%s.msg.dat" % self.basename)
         #
-        # one file per queue
-        basename = base64.urlsafe_b64encode(name)
-        self.filename = os.path.join(dir, "%s.msg.dat" % basename)
-        self.f = None
+        # state is checkpointed to the index file so a restart only has
+        # to replay what was written after the last checkpoint
+        self.index_filename = os.path.join(dir, "%s.idx" % self.basename)
+        self.checkpoint_interval_secs = checkpoint_interval_secs
+        self.next_checkpoint = time.time() + checkpoint_interval_secs
+        self.index_current = False
+        self.loaded_from_index = False
+        self.loaded = False
         self._load_or_init_state()
 
     def pending_messages(self):
@@ -334,71 +1138,172 @@ class FileQueue(BaseDestination):
         return len(self.msgs_in_use)
 
     def msg_in_use(self, id):
-        return self.msgs_in_use.has_key(id.hex)
+        return self.msgs_in_use.has_key(uuid_bytes(id))
+
+    def stats(self):
+        return { "pending"         : self.pending_message_count,
+                 "in_use"          : len(self.msgs_in_use),
+                 "requeued"        : len(self.requeued),
+                 "cache_hits"      : self.cache_hits,
+                 "cache_misses"    : self.cache_misses,
+                 "cache_entries"   : len(self.body_cache),
+                 "cache_bytes"     : self.body_cache_bytes,
+                 "segments"        : len(self.segments),
+                 "compactions"     : self.compactions,
+                 "compaction_secs" : self.compaction_secs,
+                 "bytes_reclaimed" : self.bytes_reclaimed }
+
+    def disk_usage(self):
+        total = 0
+        for seq in self._list_segments():
+            total += os.path.getsize(self._segment_path(seq))
+        return total
 
     def close(self):
-        self.f.close()
-        self.f = None
+        self.checkpoint()
+        self._close_files()
+        self.compacting.clear()
+        self.loaded = False
+
+    def sync(self):
+        for seq in self.unsynced:
+            f = self.seg_files[seq]
+            f.flush()
+            os.fsync(f.fileno())
+        self.unsynced.clear()
+        self.last_fsync = time.time()
 
     def destroy(self):
         BaseDestination.destroy(self)
+        self._close_files()
+        self.unsynced.clear()
+        self.compacting.clear()
+        self.loaded = False
+        for seq in self._list_segments():
+            self._delete_file(self._segment_path(seq))
         self._delete_file(self.filename)
+        self._delete_file(self.index_filename)
+
+    def checkpoint(self):
+        # data must be on disk before the index that describes it
+        self.sync()
+        self.next_checkpoint = time.time() + self.checkpoint_interval_secs
+        # requeued messages are saved with their -1 ack timeout
+        in_use = self.msgs_in_use.values() + self.requeued.values()
+        buf = StringIO()
+        buf.write(struct.pack(INDEX_HEADER, INDEX_MAGIC, INDEX_VERSION,
+                              self.read_seq, self.pending_file_pos,
+                              self.write_seq, self.write_pos,
+                              self.pending_message_count,
+                              len(self.segments), len(in_use)))
+        for seq, live in sorted(self.segments.items()):
+            buf.write(struct.pack(INDEX_SEGMENT, seq, live,
+                                  self.segment_live_bytes[seq],
+                                  self._segment_end(seq)))
+        for msg_header in in_use:
+            buf.write(struct.pack(INDEX_IN_USE, msg_header.seg,
+                                  msg_header.pos))
+            buf.write(msg_header.encode())
+        data = buf.getvalue()
+        (tmp_fd, tmp_path) = tempfile.mkstemp(dir=self.dir)
+        tmp_file = os.fdopen(tmp_fd, "wb")
+        tmp_file.write(data)
+        tmp_file.write(struct.pack("I", zlib.crc32(data) & 0xffffffff))
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+        tmp_file.close()
+        os.rename(tmp_path, self.index_filename)
+        self.index_current = True
+        self._dump("checkpoint")
 
-    def send(self, body):
+    def send(self, body, headers=""):
+        return self.send_many([ body ], [ headers ])[0]
+
+    def send_many(self, bodies, headers=None):
+        # messages bound for the same segment are appended with a
+        # single write and fsync, then dispatched together
+        #
+        # compress before touching any queue state: offload() lets other
+        # clients use the queue meanwhile
+        encoded = [ self._compress(body) for body in bodies ]
+        headers = headers or [ "" ] * len(bodies)
         self._open()
-        id = uuid.uuid4()
-        self.f.seek(0, 2) # go to end of file
-        msg_header = MessageHeader(self.f.tell(),
-                                   now_millis(),
-                                   0, 0, id, 0, 0)
-        msg_header.write(self.f, "", body)
-        self._fsync()
-        self.pending_message_count += 1
-        self.total_messages += 1
-        self._dump("send %s" % id.hex)
-        for k,v in self.subscribers.items():
-            if v.pull_message(self):
-                break
-        return id
+        now = now_millis()
+        ids = [ ]
+        parts = [ ]
+        start = self.write_pos
+        for (body, h, (flags, data)) in zip(bodies, headers, encoded):
+            if self.write_pos >= self.segment_size:
+                self._append(start, parts)
+                parts = [ ]
+                self._roll_segment()
+                start = self.write_pos
+            id = uuid.uuid4()
+            msg_header = MessageHeader(self.write_pos, now, 0, 0, id,
+                                       len(h), len(data), seg=self.write_seq,
+                                       flags=flags)
+            parts.append(msg_header.encode())
+            parts.append(h)
+            parts.append(data)
+            self._cache_body(msg_header, body, h)
+            self.write_pos += msg_header.total_size
+            self.segments[self.write_seq] += 1
+            self.segment_live_bytes[self.write_seq] += msg_header.total_size
+            self.pending_message_count += 1
+            ids.append(id)
+        self._append(start, parts)
+        self._dump("send %d" % len(ids))
+        self._maybe_checkpoint()
+        self.wake_subscribers()
+        return ids
 
     def receive(self, auto_ack):
         self._open()
         if self.pending_message_count > 0:
-            # grab next msg from queue file, w/body
-            msg = self._read_msg(self.pending_file_pos, True)
-            # advance file pointer and write it
-            self.pending_file_pos += msg.total_size
-            self.f.seek(0)
-            self.f.write(struct.pack("q", self.pending_file_pos))
+            if self.requeued:
+                (uid, msg) = self.requeued.popitem(last=False)
+                (body, headers) = self._read_body(msg)
+            else:
+                # grab next msg from queue file, w/body
+                (msg, body, headers) = self._next_pending()
+                self.pending_file_pos = msg.pos + msg.total_size
             # mark message dequeued
             now = now_millis()
-            self.f.seek(msg.pos+8)
-            self.f.write(struct.pack("q", now)) # dequeue time
-            self.f.write(struct.pack("q", now+self.ack_timeout_millis))
-            self._fsync()
+            msg.dequeue_time = now
+            msg.ack_timeout  = now + self.ack_timeout_millis
+            f = self._seg_file(msg.seg)
+            f.seek(msg.pos+8)
+            f.write(TIMEOUTS_CODEC.pack(msg.dequeue_time, msg.ack_timeout))
+            self._fsync(msg.seg)
             self.pending_message_count -= 1
-            self.msgs_in_use[msg.id.hex] = msg
-            self._dump("receive %s" % msg.id.hex)
+            self.deliveries += 1
+            msg.delivery = self.deliveries
+            self.msgs_in_use[msg.uid] = msg
+            self._add_deadline(msg)
+            id = msg.id
+            self._dump("receive %s" % id.hex)
             if auto_ack:
-                self.ack(msg.id)
-            return (self, msg)
+                self.ack(id)
+            return (self, Message(id, body, headers, msg.delivery))
         else:
             return None
 
     def ack(self, id):
         self._open()
-        if self.msgs_in_use.has_key(id.hex):
-            msg_header = self.msgs_in_use[id.hex]
-            del(self.msgs_in_use[id.hex])
+        uid = uuid_bytes(id)
+        if self.msgs_in_use.has_key(uid):
+            msg_header = self.msgs_in_use.pop(uid)
             # zero out the timeout, marking this message acked
-            self.f.seek(msg_header.pos + 16)
-            self.f.write(struct.pack("q", 0))
-            self._fsync()
-            active = self.pending_message_count + len(self.msgs_in_use)
-            self._dump("ack before rewrite %s" % id.hex)
-            active_pct = active / (self.total_messages * 1.0)
-            if active_pct < 0.1 and self.next_rewrite < time.time():
-                self._rewrite_file()
+            self._mark_acked(msg_header)
+            if self.sparse:
+                self._compact()
+            self._maybe_checkpoint()
+        elif self.requeued.has_key(uid):
+            # acked after its ack timeout expired, but before it was
+            # redelivered
+            msg_header = self.requeued.pop(uid)
+            self.pending_message_count -= 1
+            self._mark_acked(msg_header)
         else:
             logger.error("ack: %s: no msg in use with id: %s" % \
                          (self.name, id.hex))
@@ -406,139 +1311,665 @@ class FileQueue(BaseDestination):
 
     ##################################################################
 
-    def _rewrite_file(self):
-        start = time.time()
-        self.next_rewrite = time.time() + self.rewrite_interval_secs
-        (tmp_fd, tmp_path) = tempfile.mkstemp(dir=self.dir)
-        tmp_file = os.fdopen(tmp_fd, "w")
-        tmp_file.write(struct.pack("q", 12))
-        tmp_file.write(struct.pack("i", self.version))
-        fsize    = os.path.getsize(self.filename)
-        self.msgs_in_use.clear()
-        self.pending_message_count = 0
-        pos = 12
-        self.pending_file_pos = pos
-        remove_count = 0
-        to_requeue = [ ]
-        now_ms = now_millis()
-        self.f.seek(pos)
-        while pos < fsize:
-            write_msg = False
-            msg_header = self._read_msg(pos, False)
-            pos += msg_header.total_size
-            if msg_header.dequeue_time > 0:
-                # msg has been dequeued
-                if msg_header.ack_timeout == 0:
-                    # msg dequeued and acked. we don't need to keep it
-                    remove_count += 1
-                elif msg_header.ack_timeout < now_ms:
-                    # ack expired. re-queue
-                    to_requeue.append(msg_header)
-                else:
-                    # ack not expired - but store new file offset
-                    write_msg = True
-                    msg_header.pos = tmp_file.tell()
-                    self.msgs_in_use[msg_header.id.hex] = msg_header
+    def _maybe_checkpoint(self):
+        if time.time() >= self.next_checkpoint:
+            self.checkpoint()
+
+    def _mark_acked(self, msg_header):
+        f = self._seg_file(msg_header.seg)
+        f.seek(msg_header.pos + 16)
+        f.write(ACKED)
+        self._fsync(msg_header.seg)
+        self._release(msg_header.seg, msg_header.total_size)
+
+    def requeue_expired(self, now_ms):
+        # messages whose ack timeout passed become pending again.  only
+        # the ack timeout in their header is rewritten.
+        deadlines = self.deadlines
+        if not deadlines or deadlines[0][0] >= now_ms:
+            return
+        while deadlines and deadlines[0][0] < now_ms:
+            (ack_timeout, uid) = heapq.heappop(deadlines)
+            msg_header = self.msgs_in_use.get(uid)
+            if msg_header and msg_header.ack_timeout == ack_timeout:
+                self._requeue(msg_header)
+        self._dump("requeue_expired")
+        self.wake_subscribers()
+
+    def requeue(self, id, delivery):
+        # in use message whose session ended - its heap entry goes
+        # stale and is skipped
+        self._open()
+        msg_header = self.msgs_in_use.get(uuid_bytes(id))
+        if msg_header and msg_header.delivery == delivery:
+            self._requeue(msg_header)
+            self._dump("requeue %s" % id.hex)
+            self.wake_subscribers()
+
+    def _requeue(self, msg_header):
+        del(self.msgs_in_use[msg_header.uid])
+        f = self._seg_file(msg_header.seg)
+        f.seek(msg_header.pos + 16)
+        f.write(REQUEUED)
+        self._fsync(msg_header.seg)
+        msg_header.ack_timeout = -1
+        self.requeued[msg_header.uid] = msg_header
+        self.pending_message_count += 1
+
+    def _add_deadline(self, msg_header):
+        deadlines = self.deadlines
+        heapq.heappush(deadlines, (msg_header.ack_timeout, msg_header.uid))
+        if len(deadlines) > 2 * len(self.msgs_in_use) + 1024:
+            self._rebuild_deadlines()
+
+    def _rebuild_deadlines(self):
+        self.deadlines = [ (m.ack_timeout, m.uid) for m in
+                           self.msgs_in_use.values() ]
+        heapq.heapify(self.deadlines)
+
+    def _live_header(self, uid):
+        # in use or requeued message
+        return self.msgs_in_use.get(uid) or self.requeued.get(uid)
+
+    def _compact(self):
+        # copy the in use messages out of segments that _release()
+        # found to be sparse
+        # messages sent after a segment was found sparse are still
+        # pending, and only in use messages are copied
+        sparse = set([ seq for seq in self.sparse
+                       if not self._has_pending(seq) ])
+        self.sparse = set()
+        if self.write_seq in sparse:
+            # only in use messages left in the last segment - seal it
+            self._roll_segment()
+        seg_records = { }
+        for seq in sparse:
+            seg_records[seq] = [ ]
+        for m in self.msgs_in_use.values() + self.requeued.values():
+            if seg_records.has_key(m.seg):
+                seg_records[m.seg].append((m.uid, m.pos, m.total_size))
+        for seq, records in seg_records.items():
+            records.sort(key=lambda r: r[1])
+            self._sync_segment(seq)
+            self.compacting.add(seq)
+            callback = lambda result, error, seq=seq: \
+                       self._finish_compaction(seq, result, error)
+            args = (self._segment_path(seq), records)
+            if self.worker:
+                self.worker.submit(compact_segment, args, callback)
             else:
-                write_msg = True
-                if self.pending_message_count == 0:
-                    # position of first pending msg in new file
-                    self.pending_file_pos = tmp_file.tell()
-                self.pending_message_count += 1                    
-
-            if write_msg:
-                msg_header.copy(self.f, tmp_file)
+                callback(compact_segment(*args), None)
+
+    def _finish_compaction(self, seq, result, error):
+        # catch up with acks made while the segment was being copied,
+        # then swap the compacted copy in
+        if error:
+            logger.error("%s: compaction of segment %d failed: %s" %
+                         (self.name, seq, error))
+            self.compacting.discard(seq)
+            return
+        (tmp_path, moved, elapsed) = result
+        if seq not in self.compacting or not self.segments.has_key(seq):
+            # queue closed or every message in the segment acked meanwhile
+            self._delete_file(tmp_path)
+            return
+        self.compacting.remove(seq)
+        f = open(tmp_path, "r+b")
+        for (uid, old_pos, new_pos) in moved:
+            msg_header = self._live_header(uid)
+            if not msg_header or msg_header.seg != seq or \
+                   msg_header.pos != old_pos:
+                f.seek(new_pos + 16)
+                f.write(ACKED)
             else:
-                self.f.seek(msg_header.header_size,1)
-                self.f.seek(msg_header.body_size,1)
-
-        # add ack expired messages to end of queue
-        for msg_header in to_requeue:
-            msg_header.dequeue_time = 0
-            msg_header.ack_timeout  = 0
-            if self.pending_message_count == 0:
-                # position of first pending msg in new file
-                self.pending_file_pos = tmp_file.tell()
-            msg_header.copy(self.f, tmp_file)
-            self.pending_message_count += 1
+                # requeued or redelivered while being copied
+                f.seek(new_pos + 8)
+                f.write(TIMEOUTS_CODEC.pack(msg_header.dequeue_time,
+                                            msg_header.ack_timeout))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        self._close_segment_file(seq)
+        old_size = self.segment_ends[seq]
+        os.rename(tmp_path, self._segment_path(seq))
+        for (uid, old_pos, new_pos) in moved:
+            msg_header = self._live_header(uid)
+            if msg_header and msg_header.seg == seq and \
+                   msg_header.pos == old_pos:
+                msg_header.pos = new_pos
+        self.segment_ends[seq] = os.path.getsize(self._segment_path(seq))
+        self.compactions += 1
+        self.compaction_secs += elapsed
+        self.bytes_reclaimed += old_size - self.segment_ends[seq]
+        # message offsets changed, so the index must be rewritten
+        self.checkpoint()
+        self._dump("_finish_compaction")
+
+    def _has_pending(self, seq):
+        return seq > self.read_seq or (seq == self.read_seq and
+                    self.pending_file_pos < self._segment_end(seq))
+
+    def _compress(self, body):
+        # (record flags, data to write)
+        if not self.compress_files or len(body) < self.compress_min_bytes:
+            return (0, body)
+        if self.offload and len(body) >= self.offload_min_bytes:
+            data = self.offload(zlib.compress, body)
+        else:
+            data = zlib.compress(body)
+        if len(data) >= len(body):
+            # incompressible - store it as is
+            return (0, body)
+        return (COMPRESSED, data)
+
+    def _append(self, pos, parts):
+        if parts:
+            f = self._seg_file(self.write_seq)
+            f.seek(pos)
+            f.write("".join(parts))
+            self._fsync(self.write_seq)
+
+    def _read_body(self, msg_header):
+        # (body, headers)
+        self.cache_misses += 1
+        seq = msg_header.seg
+        start = msg_header.pos + 48
+        end = start + msg_header.header_size + msg_header.body_size
+        m = self._seg_map(seq, end)
+        if m:
+            data = m[start:end]
+        else:
+            f = self._seg_file(seq)
+            f.seek(start)
+            data = f.read(end - start)
+        headers = data[:msg_header.header_size]
+        body = data[msg_header.header_size:]
+        if msg_header.flags & COMPRESSED:
+            body = zlib.decompress(body)
+        return (body, headers)
+
+    def _next_pending(self):
+        while True:
+            seq = self.read_seq
+            pos = self.pending_file_pos
+            if pos >= self._segment_end(seq):
+                self._close_segment_file(seq)
+                self.read_seq += 1
+                self.pending_file_pos = SEGMENT_HEADER_SIZE
+                continue
+            # sent by this process, so it can't have been dequeued yet
+            cached = self.body_cache.pop((seq, pos), None)
+            if cached:
+                self.body_cache_bytes -= len(cached[1])
+                self.cache_hits += 1
+                return cached
+            m = self._seg_map(seq, pos + 48)
+            if m:
+                msg = decode_header(m[pos:pos+48], pos, seq)
+            else:
+                msg = self._read_msg(seq, pos)
+            if msg.dequeue_time == 0:
+                (body, headers) = self._read_body(msg)
+                return (msg, body, headers)
+            # dequeued before a restart - skip it
+            self.pending_file_pos += msg.total_size
 
-        self.total_messages = self.pending_message_count+len(self.msgs_in_use)
-        self.f.close()
-        tmp_file.seek(0,0)
-        tmp_file.write(struct.pack("q", self.pending_file_pos))
-        tmp_file.close()
-        os.rename(tmp_path, self.filename)
-        self.f = open(self.filename, "r+")
-        self.f.write(struct.pack("q", self.pending_file_pos))
-        self.f.write(struct.pack("i", self.version))
-        self._fsync(True)
-        #elapsed = int((time.time() - start) * 1000)
-        #print "_rewrite_file. elapsed=%d old_size=%d new_size=%d - kept=%d requeued=%d  removed=%d" %  (elapsed, fsize, os.path.getsize(self.filename), self.total_messages, len(to_requeue), remove_count)
-        self._dump("_rewrite_file")
+    def _cache_body(self, msg_header, body, headers):
+        if len(body) > self.body_cache_max_bytes:
+            return
+        cache = self.body_cache
+        cache[(msg_header.seg, msg_header.pos)] = (msg_header, body, headers)
+        self.body_cache_bytes += len(body)
+        while self.body_cache_bytes > self.body_cache_max_bytes:
+            (key, (m, evicted, h)) = cache.popitem(last=False)
+            self.body_cache_bytes -= len(evicted)
+
+    def _clear_body_cache(self):
+        self.body_cache.clear()
+        self.body_cache_bytes = 0
+
+    def _seg_map(self, seq, end):
+        # map of the segment covering at least the first end bytes, or
+        # None if the segment can't be mapped
+        m = self.seg_maps.get(seq)
+        if m is not None and len(m) >= end:
+            return m
+        self._close_segment_map(seq)
+        f = self._seg_file(seq)
+        f.flush()
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            return None
+        if len(m) < end:
+            m.close()
+            return None
+        self.seg_maps[seq] = m
+        return m
+
+    def _close_segment_map(self, seq):
+        if self.seg_maps.has_key(seq):
+            self.seg_maps.pop(seq).close()
+
+    def _release(self, seq, size):
+        self.segments[seq] -= 1
+        self.segment_live_bytes[seq] -= size
+        if self.segments[seq] == 0:
+            if seq != self.write_seq:
+                self._remove_segment(seq)
+            elif self.pending_message_count == 0:
+                self._reset_tail()
+        elif self.segment_live_bytes[seq] < 0.1 * self._segment_end(seq) and \
+                 seq not in self.compacting and not self._has_pending(seq):
+            # the last segment is only sealed for compaction once it's
+            # at least half full.  a small one is left to _reset_tail(),
+            # or else a queue that drains while a few messages are in
+            # use would start a new segment every time
+            if seq != self.write_seq or \
+                   self.write_pos >= self.segment_size / 2:
+                self.sparse.add(seq)
+
+    def _roll_segment(self):
+        self.segment_ends[self.write_seq] = self.write_pos
+        if self.read_seq != self.write_seq:
+            self._close_segment_file(self.write_seq)
+        self.write_seq += 1
+        self.write_pos = SEGMENT_HEADER_SIZE
+        self._create_segment(self.write_seq)
+
+    def _reset_tail(self):
+        # every message in the queue is acked - empty the last segment.
+        # the checkpoint no longer matches the segment, so drop it
+        if self.index_current:
+            self._delete_file(self.index_filename)
+            self.index_current = False
+        # reading a map past the end of a file is fatal
+        self._close_segment_map(self.write_seq)
+        self._clear_body_cache()
+        f = self._seg_file(self.write_seq)
+        f.truncate(SEGMENT_HEADER_SIZE)
+        self.segment_live_bytes[self.write_seq] = 0
+        self.sparse.discard(self.write_seq)
+        self.write_pos = SEGMENT_HEADER_SIZE
+        self.read_seq = self.write_seq
+        self.pending_file_pos = SEGMENT_HEADER_SIZE
+        self._fsync(self.write_seq)
+
+    def _remove_segment(self, seq):
+        self._close_segment_file(seq)
+        self._delete_file(self._segment_path(seq))
+        del(self.segments[seq])
+        del(self.segment_live_bytes[seq])
+        self.sparse.discard(seq)
+        if self.segment_ends.has_key(seq):
+            del(self.segment_ends[seq])
+        if seq == self.read_seq:
+            self.read_seq += 1
+            self.pending_file_pos = SEGMENT_HEADER_SIZE
+
+    def _create_segment(self, seq):
+        f = open(self._segment_path(seq), "w+b")
+        f.write(struct.pack("4si", SEGMENT_MAGIC, self.version))
+        self.seg_files[seq] = f
+        self.segments[seq] = 0
+        self.segment_live_bytes[seq] = 0
+        self._fsync(seq)
+        return f
+
+    def _seg_file(self, seq):
+        f = self.seg_files.get(seq)
+        if not f:
+            f = open(self._segment_path(seq), "r+b")
+            self.seg_files[seq] = f
+        return f
+
+    def _sync_segment(self, seq):
+        if seq in self.unsynced:
+            self.unsynced.remove(seq)
+            f = self.seg_files[seq]
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _close_files(self):
+        for m in self.seg_maps.values():
+            m.close()
+        self.seg_maps.clear()
+        for f in self.seg_files.values():
+            f.close()
+        self.seg_files.clear()
+        self._clear_body_cache()
+
+    def _close_segment_file(self, seq):
+        self._close_segment_map(seq)
+        if self.seg_files.has_key(seq):
+            self._sync_segment(seq)
+            self.seg_files.pop(seq).close()
+
+    def _segment_end(self, seq):
+        if seq == self.write_seq:
+            return self.write_pos
+        return self.segment_ends[seq]
+
+    def _segment_path(self, seq):
+        return os.path.join(self.dir, "%s.%010d.seg" % (self.basename, seq))
+
+    def _list_segments(self):
+        prefix = self.basename + "."
+        seqs = [ ]
+        for fname in os.listdir(self.dir):
+            if fname.startswith(prefix) and fname.endswith(".seg"):
+                seq = fname[len(prefix):-4]
+                if seq.isdigit():
+                    seqs.append(int(seq))
+        seqs.sort()
+        return seqs
 
     def _open(self):
-        if not self.f:
+        if not self.loaded:
             self._load_or_init_state()
 
     def _load_or_init_state(self):
+        self._clear_body_cache()
         self.pending_message_count = 0
         self.msgs_in_use.clear()
+        self.requeued.clear()
+        self.segments.clear()
+        self.segment_live_bytes.clear()
+        self.segment_ends.clear()
+        self.sparse.clear()
         if os.path.exists(self.filename):
-            self._load_state()
+            self._migrate_file()
+        seqs = self._list_segments()
+        self.loaded_from_index = False
+        if seqs and os.path.exists(self.index_filename):
+            self.loaded_from_index = self._load_index(seqs)
+            if not self.loaded_from_index:
+                logger.error("%s: invalid index file, rescanning segments" %
+                             self.name)
+                self._delete_file(self.index_filename)
+                self.pending_message_count = 0
+                self.msgs_in_use.clear()
+                self.requeued.clear()
+                self.segments.clear()
+                self.segment_live_bytes.clear()
+                self.segment_ends.clear()
+        if self.loaded_from_index:
+            self.index_current = True
+        elif seqs:
+            self._load_state(seqs)
         else:
-            self.pending_file_pos = 12
-            self.f = open(self.filename, "w")
-            self.f.write(struct.pack("q", self.pending_file_pos))
-            self.f.write(struct.pack("i", self.version))
-            self.f.close()
-            self.f = open(self.filename, "r+")
-        self.total_messages = self.pending_message_count+len(self.msgs_in_use)
+            self._delete_file(self.index_filename)
+            self.write_seq = 1
+            self.write_pos = SEGMENT_HEADER_SIZE
+            self.read_seq  = 1
+            self.pending_file_pos = SEGMENT_HEADER_SIZE
+            self._create_segment(self.write_seq)
+        self._rebuild_deadlines()
+        self.loaded = True
         self._dump("init")
 
-    def _load_state(self):
-        finfo = os.stat(self.filename)
-        fsize = finfo.st_size
-        self.f = open(self.filename, "r+")
-        self.pending_file_pos = struct.unpack("q", self.f.read(8))[0]
-        self.version = struct.unpack("i", self.f.read(4))[0]
-        pos = 12
-        while pos < fsize:
-            self._dump("_load_state")
-            msg_header = self._read_msg(pos, False)
-            if msg_header.dequeue_time > 0:
-                if msg_header.ack_timeout > 0:
-                    self.msgs_in_use[msg_header.id.hex] = msg_header
+    def _load_state(self, seqs):
+        read_seq = None
+        for seq in seqs:
+            f = self._seg_file(seq)
+            fsize = os.fstat(f.fileno()).st_size
+            (magic, version) = struct.unpack("4si", f.read(8))
+            if magic != SEGMENT_MAGIC:
+                raise IOError("Invalid segment file: %s" %
+                              self._segment_path(seq))
+            live = 0
+            live_bytes = 0
+            pos = SEGMENT_HEADER_SIZE
+            while pos < fsize:
+                self._dump("_load_state")
+                msg_header = None
+                if pos + 48 <= fsize:
+                    msg_header = self._read_msg(seq, pos)
+                if not msg_header or pos + msg_header.total_size > fsize:
+                    # partial write - broker stopped while appending
+                    logger.error("%s: truncating segment %d at %d" %
+                                 (self.name, seq, pos))
+                    f.truncate(pos)
+                    fsize = pos
+                    break
+                if msg_header.dequeue_time > 0:
+                    if msg_header.ack_timeout > 0:
+                        self.msgs_in_use[msg_header.uid] = msg_header
+                        live += 1
+                        live_bytes += msg_header.total_size
+                    elif msg_header.ack_timeout < 0:
+                        self.requeued[msg_header.uid] = msg_header
+                        self.pending_message_count += 1
+                        live += 1
+                        live_bytes += msg_header.total_size
+                else:
+                    if read_seq is None:
+                        read_seq = seq
+                        self.pending_file_pos = pos
+                    self.pending_message_count += 1
+                    live += 1
+                    live_bytes += msg_header.total_size
+                pos += msg_header.total_size
+            self.segments[seq] = live
+            self.segment_live_bytes[seq] = live_bytes
+            self.segment_ends[seq] = fsize
+        self._finish_load(seqs, read_seq)
+
+    def _load_index(self, seqs):
+        # restore the last checkpoint, then replay everything from the
+        # checkpointed read position on: messages dequeued since then
+        # and messages appended after the checkpointed end of the queue
+        index = self._read_index()
+        if not index:
+            return False
+        (read_seq, read_pos, write_seq, write_pos, pending,
+         index_segs, index_in_use) = index
+        sizes = { }
+        for seq in seqs:
+            sizes[seq] = os.path.getsize(self._segment_path(seq))
+        # validate index against the segment files
+        if not sizes.has_key(write_seq) or sizes[write_seq] < write_pos:
+            return False
+        for seq in seqs:
+            if seq <= write_seq and not index_segs.has_key(seq):
+                return False
+        for seq, (live, live_bytes, end) in index_segs.items():
+            if seq != write_seq and sizes.has_key(seq) and sizes[seq] != end:
+                return False
+
+        in_use_count = { }
+        for msg_header in index_in_use:
+            in_use_count[msg_header.seg] = \
+                in_use_count.get(msg_header.seg, 0) + 1
+        for seq, (live, live_bytes, end) in index_segs.items():
+            if sizes.has_key(seq):
+                self.segments[seq] = live
+                self.segment_live_bytes[seq] = live_bytes
+            elif seq >= read_seq:
+                # segment unlinked since: its pending messages were acked
+                pending -= live - in_use_count.get(seq, 0)
+        for seq in seqs:
+            if seq > write_seq:
+                self.segments[seq] = 0
+                self.segment_live_bytes[seq] = 0
+
+        # in use messages may have been acked or requeued since the
+        # checkpoint.  requeued ones were counted as pending.
+        for msg_header in index_in_use:
+            seq = msg_header.seg
+            was_requeued = msg_header.ack_timeout < 0
+            if not sizes.has_key(seq):
+                if was_requeued:
+                    pending -= 1
+                continue
+            current = self._read_msg(seq, msg_header.pos)
+            if current.uid != msg_header.uid:
+                return False
+            if current.ack_timeout > 0:
+                self.msgs_in_use[current.uid] = current
+                if was_requeued:
+                    pending -= 1
+            elif current.ack_timeout < 0:
+                self.requeued[current.uid] = current
+                if not was_requeued:
+                    pending += 1
             else:
-                self.pending_message_count += 1
-            pos += msg_header.total_size
-
-    def _read_msg(self, pos, read_contents):
-        self.f.seek(pos, 0)
-        msg = MessageHeader(pos=self.f.tell(),
-                            create_time =struct.unpack("q", self.f.read(8))[0],
-                            dequeue_time=struct.unpack("q", self.f.read(8))[0],
-                            ack_timeout =struct.unpack("q", self.f.read(8))[0],
-                            id=uuid.UUID(bytes=self.f.read(16)),
-                            header_size=struct.unpack("i", self.f.read(4))[0],
-                            body_size=struct.unpack("i", self.f.read(4))[0])
-        if read_contents:
-            if msg.header_size > 0:
-                msg.header = self.f.read(msg.header_size)
-            if msg.body_size > 0:
-                msg.body = self.f.read(msg.body_size)
-        return msg
+                self.segments[seq] -= 1
+                self.segment_live_bytes[seq] -= current.total_size
+                if was_requeued:
+                    pending -= 1
+
+        first_pending = None
+        for seq in seqs:
+            if seq < read_seq:
+                continue
+            pos = SEGMENT_HEADER_SIZE
+            if seq == read_seq:
+                pos = read_pos
+            while pos < sizes[seq]:
+                checkpointed = (seq, pos) < (write_seq, write_pos)
+                if first_pending and checkpointed:
+                    # rest of the checkpointed queue is still pending
+                    if seq < write_seq:
+                        break
+                    pos = write_pos
+                    continue
+                msg_header = None
+                if pos + 48 <= sizes[seq]:
+                    msg_header = self._read_msg(seq, pos)
+                if not msg_header or pos+msg_header.total_size > sizes[seq]:
+                    if seq != seqs[-1] or checkpointed:
+                        return False
+                    logger.error("%s: truncating segment %d at %d" %
+                                 (self.name, seq, pos))
+                    self._seg_file(seq).truncate(pos)
+                    sizes[seq] = pos
+                    break
+                size = msg_header.total_size
+                if msg_header.dequeue_time > 0:
+                    live = msg_header.ack_timeout != 0
+                    if msg_header.ack_timeout > 0:
+                        self.msgs_in_use[msg_header.uid] = msg_header
+                    elif msg_header.ack_timeout < 0:
+                        self.requeued[msg_header.uid] = msg_header
+                        pending += 1
+                    if checkpointed:
+                        # was pending at checkpoint
+                        pending -= 1
+                        if not live:
+                            self.segments[seq] -= 1
+                            self.segment_live_bytes[seq] -= size
+                    elif live:
+                        self.segments[seq] += 1
+                        self.segment_live_bytes[seq] += size
+                else:
+                    if not first_pending:
+                        first_pending = (seq, pos)
+                    if not checkpointed:
+                        pending += 1
+                        self.segments[seq] += 1
+                        self.segment_live_bytes[seq] += size
+                pos += msg_header.total_size
+
+        self.pending_message_count = pending
+        for seq in seqs:
+            self.segment_ends[seq] = sizes[seq]
+        new_read_seq = None
+        if first_pending:
+            (new_read_seq, self.pending_file_pos) = first_pending
+        self._finish_load(seqs, new_read_seq)
+        self._dump("_load_index")
+        return True
+
+    def _read_index(self):
+        f = open(self.index_filename, "rb")
+        data = f.read()
+        f.close()
+        head_size = struct.calcsize(INDEX_HEADER)
+        if len(data) < head_size + 4:
+            return None
+        (crc,) = struct.unpack("I", data[-4:])
+        data = data[:-4]
+        if crc != (zlib.crc32(data) & 0xffffffff):
+            return None
+        (magic, version, read_seq, read_pos, write_seq, write_pos, pending,
+         seg_count, in_use_count) = struct.unpack(INDEX_HEADER,
+                                                  data[:head_size])
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            return None
+        buf = StringIO(data)
+        buf.seek(head_size)
+        seg_size = struct.calcsize(INDEX_SEGMENT)
+        segs = { }
+        for i in range(seg_count):
+            (seq, live, live_bytes, end) = struct.unpack(INDEX_SEGMENT,
+                                                         buf.read(seg_size))
+            segs[seq] = (live, live_bytes, end)
+        in_use_size = struct.calcsize(INDEX_IN_USE)
+        in_use = [ ]
+        for i in range(in_use_count):
+            (seq, pos) = struct.unpack(INDEX_IN_USE, buf.read(in_use_size))
+            msg_header = decode_header(buf.read(48), pos, seq)
+            in_use.append(msg_header)
+        return (read_seq, read_pos, write_seq, write_pos, pending,
+                segs, in_use)
+
+    def _finish_load(self, seqs, read_seq):
+        self.write_seq = seqs[-1]
+        self.write_pos = self.segment_ends.pop(self.write_seq)
+        if read_seq is None:
+            read_seq = self.write_seq
+            self.pending_file_pos = self.write_pos
+        self.read_seq = read_seq
+        for seq in seqs:
+            if self.segments[seq] == 0:
+                if seq != self.write_seq:
+                    self._remove_segment(seq)
+                elif self.pending_message_count == 0 and \
+                         self.write_pos > SEGMENT_HEADER_SIZE:
+                    self._reset_tail()
+            elif seq != self.read_seq and seq != self.write_seq:
+                self._close_segment_file(seq)
+
+    def _migrate_file(self):
+        # copy pending and in use messages from a version 1 .msg.dat
+        # file into the first segment. if segments already exist the
+        # migration finished before the .msg.dat file was removed
+        if not self._list_segments():
+            (tmp_fd, tmp_path) = tempfile.mkstemp(dir=self.dir)
+            tmp_file = os.fdopen(tmp_fd, "w+b")
+            tmp_file.write(struct.pack("4si", SEGMENT_MAGIC, self.version))
+            old_file = open(self.filename, "rb")
+            fsize = os.path.getsize(self.filename)
+            pos = LEGACY_HEADER_SIZE
+            while pos + 48 <= fsize:
+                msg_header = read_msg(old_file, pos)
+                if msg_header.dequeue_time == 0 or msg_header.ack_timeout > 0:
+                    msg_header.copy(old_file, tmp_file, tmp_file.tell())
+                pos += msg_header.total_size
+            old_file.close()
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+            tmp_file.close()
+            os.rename(tmp_path, self._segment_path(1))
+        os.remove(self.filename)
+
+    def _read_msg(self, seq, pos):
+        return read_msg(self._seg_file(seq), pos, seq)
 
     def _delete_file(self, filename):
         if os.path.exists(filename):
             os.remove(filename)
 
-    def _fsync(self, force=False):
-        self.f.flush()
-        if force or (time.time() > (self.last_fsync + self.fsync_seconds)):
-            os.fsync(self.f.fileno())
-            self.last_fsync = time.time()
+    def _fsync(self, seq, force=False):
+        self.seg_files[seq].flush()
+        self.unsynced.add(seq)
+        if force or (not self.committer and
+                     time.time() >= (self.last_fsync + self.fsync_seconds)):
+            self.sync()
+        elif self.committer:
+            self.committer.mark_dirty(self)
 
     def _dump(self, msg):
-        #print "%s - pos=%d pending=%d in_use=%d" % (msg, self.pending_file_pos, self.pending_message_count, len(self.msgs_in_use))
+        #print "%s - seg=%d pos=%d pending=%d in_use=%d" % (msg, self.read_seq, self.pending_file_pos, self.pending_message_count, len(self.msgs_in_use))
         pass
-
@@ -0,0 +1,139 @@
+#
+# asyncio based server, an alternative to GeventReactor.  Each client is
+# an asyncio.Protocol that feeds received bytes straight into the STOMP
+# frame parser, so there is no greenlet per client and no blocking
+# reads.  Runs on trollius (the asyncio backport) under Python 2, and
+# optionally on uvloop where it is available.
+#
+# Only the server side is provided: StompClient needs blocking reads,
+# so clients still use GeventReactor.
+#
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from radiator import logger
+from stomp import StompServer
+from outbound import BufferedConnection, check_policy, new_stats
+
+class AsyncioReactor(object):
+
+    def __init__(self, host, port, max_outbound_bytes=1048576,
+                 slow_consumer_policy="drop-oldest", use_uvloop=False,
+                 loop=None):
+        check_policy(slow_consumer_policy)
+        if use_uvloop:
+            # ImportError if uvloop isn't installed
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        self.host = host
+        self.port = port
+        self.loop = loop or asyncio.get_event_loop()
+        # same meaning as for GeventReactor.  bytes already handed to the
+        # transport count against the limit too.
+        self.max_outbound_bytes = max_outbound_bytes
+        self.slow_consumer_policy = slow_consumer_policy
+        self.slow_consumer_stats = new_stats()
+        self.server = None
+
+    def start_server(self, broker, blocking=False):
+        # broker.offload is left unset: nothing here can wait for a
+        # thread without blocking the loop, so bodies are compressed
+        # inline
+        def protocol():
+            return AsyncioConnection(broker, self.max_outbound_bytes,
+                                     self.slow_consumer_policy,
+                                     self.slow_consumer_stats, self.loop)
+
+        def tick():
+            # see GeventReactor.start_server
+            try:
+                broker.tick()
+            except Exception, e:
+                logger.exception("broker tick failed: %s" % e)
+            self.loop.call_later(broker.tick_interval_secs, tick)
+
+        self.server = self.loop.run_until_complete(
+            self.loop.create_server(protocol, self.host, self.port))
+        self.loop.call_later(broker.tick_interval_secs, tick)
+        if blocking:
+            self.loop.run_forever()
+
+    def stop(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+        self.loop.stop()
+
+class AsyncioConnection(asyncio.Protocol, BufferedConnection):
+
+    def __init__(self, broker, max_outbound_bytes=0, policy="drop-oldest",
+                 stats=None, loop=None):
+        self.broker = broker
+        self.loop = loop or asyncio.get_event_loop()
+        self.transport = None
+        self.server = None
+        # frames queued by send() are handed to the transport in one
+        # write once the current callback returns.
+        self._init_outbound(max_outbound_bytes, policy, stats)
+        self.flush_scheduled = False
+
+    ##################################################################
+    # asyncio.Protocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server = StompServer(self, self.broker)
+
+    def data_received(self, data):
+        self.server.feed(data)
+        if not self.server.connected:
+            # DISCONNECT
+            self.close()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.server.closed()
+
+    ##################################################################
+    # connection interface used by StompServer, with send() and
+    # send_lossy() from BufferedConnection
+
+    def disconnect(self):
+        self.closed = True
+        self._discard_outbound()
+        if self.transport:
+            self.transport.abort()
+
+    def flush(self):
+        if not self.outbound:
+            return
+        data = self._take_outbound()
+        self.outbound_bytes -= len(data)
+        if not self.closed:
+            self.transport.write(data)
+
+    def close(self):
+        self.flush()
+        if self.transport:
+            self.transport.close()
+
+    ##################################################################
+
+    def _buffered(self):
+        # bytes already handed to the transport count too
+        size = self.outbound_bytes
+        if self.transport:
+            size += self.transport.get_write_buffer_size()
+        return size
+
+    def _flush_later(self):
+        self.flush_scheduled = False
+        self.flush()
+
+    def _schedule_flush(self):
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self._flush_later)
@@ -0,0 +1,119 @@
+#
+# Outbound frame queue shared by the server connections of GeventReactor
+# and AsyncioReactor.  Frames queued by send() are written together by
+# the connection's flush() once the current greenlet or callback is
+# done, so a topic fan-out or a burst of receipts costs one write per
+# connection instead of one per frame.
+#
+# Topic messages are queued with send_lossy().  A slow client must not
+# stall the publisher, so once max_outbound_bytes are buffered the
+# slow consumer policy decides what to give up:
+#
+#   drop-oldest  - drop queued topic messages, oldest first, to make room
+#   drop-newest  - drop the message being sent
+#   disconnect   - drop the client
+#
+# Queue messages and receipts are never dropped.
+#
+
+from collections import deque
+
+SLOW_CONSUMER_POLICIES = ("drop-oldest", "drop-newest", "disconnect")
+
+def check_policy(policy):
+    if policy not in SLOW_CONSUMER_POLICIES:
+        raise ValueError("Invalid slow_consumer_policy: %s" % policy)
+
+def new_stats():
+    return { "dropped_oldest" : 0, "dropped_newest" : 0, "disconnected" : 0 }
+
+class BufferedConnection(object):
+
+    # subclasses call _init_outbound() and provide flush(), disconnect()
+    # and _schedule_flush()
+
+    def _init_outbound(self, max_outbound_bytes, policy, stats):
+        # 0 writes every frame immediately (clients)
+        self.max_outbound_bytes = max_outbound_bytes
+        self.policy = policy
+        # counts shared by all of a reactor's connections
+        self.stats = stats
+        if stats is None:
+            self.stats = new_stats()
+        # (size, lossy, parts) per frame
+        self.outbound = deque()
+        self.outbound_bytes = 0
+        self.closed = False
+
+    def send(self, *parts):
+        # a frame may be sent in parts so a frame body shared by many
+        # connections is queued by reference rather than copied
+        self._queue(parts, False)
+        if self.outbound_bytes >= self.max_outbound_bytes:
+            self.flush()
+
+    def send_lossy(self, *parts):
+        size = 0
+        for data in parts:
+            size += len(data)
+        over = self._buffered() + size - self.max_outbound_bytes
+        if self.max_outbound_bytes == 0 or over <= 0:
+            self._queue(parts, True, size)
+        elif self.policy == "disconnect":
+            self.stats["disconnected"] += 1
+            self.disconnect()
+        elif self.policy == "drop-oldest" and self._drop_oldest(over):
+            self._queue(parts, True, size)
+        else:
+            self.stats["dropped_newest"] += 1
+
+    def _buffered(self):
+        # bytes counted against max_outbound_bytes
+        return self.outbound_bytes
+
+    def _queue(self, parts, lossy, size=None):
+        if self.closed:
+            return
+        if size is None:
+            size = 0
+            for data in parts:
+                size += len(data)
+        self.outbound.append((size, lossy, parts))
+        self.outbound_bytes += size
+        self._schedule_flush()
+
+    def _take_outbound(self):
+        # the queued frames as one buffer.  outbound_bytes is left for
+        # the caller to reduce once it has been written.
+        data = "".join([ d for (size, lossy, parts) in self.outbound
+                           for d in parts ])
+        self.outbound.clear()
+        return data
+
+    def _discard_outbound(self):
+        for (size, lossy, parts) in self.outbound:
+            self.outbound_bytes -= size
+        self.outbound.clear()
+
+    def _drop_oldest(self, needed):
+        # drops the oldest lossy frames not yet handed to the socket.
+        # returns False if that can't free enough space.
+        dropped = 0
+        for (size, lossy, parts) in self.outbound:
+            if lossy:
+                dropped += size
+                if dropped >= needed:
+                    break
+        if dropped < needed:
+            return False
+        kept = deque()
+        for frame in self.outbound:
+            (size, lossy, parts) = frame
+            if lossy and needed > 0:
+                needed -= size
+                self.outbound_bytes -= size
+                self.stats["dropped_oldest"] += 1
+            else:
+                kept.append(frame)
+        self.outbound = kept
+        return True
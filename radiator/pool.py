@@ -0,0 +1,157 @@
+#
+# A fixed set of StompClient connections shared by many greenlets.
+# Each send() or call() takes a connection no one else is using, so
+# producers don't interleave frames on one socket or wait on each
+# other's receipts, and connections are made once rather than per
+# producer.  With several broker addresses the connections are spread
+# over them.
+#
+# A connection that fails is dropped and made again when next needed.
+# An address that refuses connections is retried with exponential
+# backoff, meanwhile connections go to the other addresses.  A
+# connection left idle for health_check_secs is checked for EOF before
+# it's used.
+#
+# Connections use gevent sockets, so threads must be monkey patched
+# to share a pool.
+#
+
+import time
+import random
+from contextlib import contextmanager
+
+import gevent
+from gevent.queue import Queue
+
+from radiator import RadiatorError, RadiatorTimeout
+from reactor import GeventReactor
+
+class StompClientPool(object):
+
+    def __init__(self, addresses, size=4, client_timeout=None,
+                 backoff_secs=0.1, max_backoff_secs=30, connect_timeout=10,
+                 health_check_secs=5, retries=1):
+        # addresses: list of (host, port)
+        self.reactors = [ GeventReactor(host, port,
+                                        client_timeout=client_timeout)
+                          for (host, port) in addresses ]
+        self.size = size
+        self.backoff_secs = backoff_secs
+        self.max_backoff_secs = max_backoff_secs
+        # how long to wait for any address to accept a connection
+        self.connect_timeout = connect_timeout
+        self.health_check_secs = health_check_secs
+        # how many times send() and call() are retried on another
+        # connection after theirs failed.  the broker may have the
+        # message already, so a retried send may be delivered twice.
+        self.retries = retries
+        # per address: failed connects in a row, and when to try again
+        self.failures = [ 0 ] * len(addresses)
+        self.retry_at = [ 0 ] * len(addresses)
+        # (slot, StompClient or None if not connected, time last used)
+        # for each connection not in use.  slot n prefers address
+        # n % len(addresses)
+        self.idle = Queue()
+        for slot in range(size):
+            self.idle.put((slot, None, 0))
+        self.closed = False
+
+    def send(self, dest_name, body, headers=None, receipt=False):
+        return self._run(lambda c: c.send(dest_name, body, headers, receipt))
+
+    def call(self, dest_name, body, timeout=60, headers=None):
+        return self._run(lambda c: c.call(dest_name, body, timeout,
+                                          headers=headers))
+
+    @contextmanager
+    def client(self):
+        # with pool.client() as c: ...  for anything else.  c is not
+        # retried, and is dropped if it disconnects.
+        (slot, client) = self._checkout()
+        try:
+            yield client
+        finally:
+            self._checkin(slot, client)
+
+    def close(self):
+        # connections in use are closed when they're returned
+        self.closed = True
+        while not self.idle.empty():
+            (slot, client, last_used) = self.idle.get()
+            self._disconnect(client)
+
+    def _run(self, fn):
+        attempt = 0
+        while True:
+            (slot, client) = self._checkout()
+            try:
+                return fn(client)
+            except RadiatorError:
+                # the broker refused the frame, the connection is fine
+                raise
+            except (IOError, BufferError):
+                self._disconnect(client)
+                client = None
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+            finally:
+                self._checkin(slot, client)
+
+    def _checkout(self):
+        (slot, client, last_used) = self.idle.get()
+        try:
+            if client and time.time() - last_used >= self.health_check_secs:
+                # notices a connection the broker closed while idle
+                client.drain(timeout=0.001)
+            if not client or not client.connected:
+                self._disconnect(client)
+                client = self._connect(slot)
+        except:
+            self.idle.put((slot, None, 0))
+            raise
+        return (slot, client)
+
+    def _checkin(self, slot, client):
+        if client and (self.closed or not client.connected):
+            self._disconnect(client)
+            client = None
+        self.idle.put((slot, client, time.time()))
+
+    def _connect(self, slot):
+        if self.closed:
+            raise IOError("StompClientPool is closed")
+        count = len(self.reactors)
+        deadline = time.time() + self.connect_timeout
+        while True:
+            now = time.time()
+            for i in range(count):
+                addr = (slot + i) % count
+                if self.retry_at[addr] > now:
+                    continue
+                try:
+                    client = self.reactors[addr].start_client_sync()
+                except (IOError, RadiatorTimeout):
+                    self._backoff(addr)
+                    continue
+                self.failures[addr] = 0
+                return client
+            wait = min(self.retry_at) - time.time()
+            if time.time() + wait > deadline:
+                raise IOError("No broker accepted a connection within %d "
+                              "seconds" % self.connect_timeout)
+            gevent.sleep(max(0, wait))
+
+    def _backoff(self, addr):
+        self.failures[addr] += 1
+        delay = min(self.max_backoff_secs,
+                    self.backoff_secs * 2 ** (self.failures[addr] - 1))
+        # jittered, so clients don't all come back at once
+        self.retry_at[addr] = time.time() + delay * random.uniform(0.5, 1)
+
+    def _disconnect(self, client):
+        if client and client.f:
+            try:
+                client.disconnect()
+            except (IOError, BufferError):
+                pass
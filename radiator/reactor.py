@@ -1,19 +1,33 @@
 import gevent
 from gevent import Greenlet, Timeout
+from gevent.event import Event
+from gevent.lock import Semaphore
 from gevent.pool import Pool
 from gevent.server import StreamServer
-from gevent.socket import create_connection
+from gevent.socket import create_connection, timeout as socket_timeout
+from gevent.socket import error as socket_error, SHUT_RDWR
 
-from radiator import RadiatorTimeout
+from radiator import RadiatorTimeout, logger
 from stomp import StompServer, StompClient
+from outbound import BufferedConnection, check_policy, new_stats
 
 class GeventReactor(object):
 
-    def __init__(self, host, port, pool_size=5000, client_timeout=None):
+    def __init__(self, host, port, pool_size=5000, client_timeout=None,
+                 max_outbound_bytes=1048576,
+                 slow_consumer_policy="drop-oldest"):
+        check_policy(slow_consumer_policy)
         self.host = host
         self.port = port
         self.pool_size = pool_size
         self.client_timeout = client_timeout
+        # server side connections coalesce writes up to this many bytes
+        self.max_outbound_bytes = max_outbound_bytes
+        # what to do with topic messages for a client whose outbound
+        # queue is full (see radiator.outbound)
+        self.slow_consumer_policy = slow_consumer_policy
+        # totals across all server connections
+        self.slow_consumer_stats = new_stats()
 
     def sleep(self, seconds):
         gevent.sleep(seconds)
@@ -21,66 +35,150 @@ class GeventReactor(object):
     def join(self, t):
         t.join()
 
-    def start_server(self, broker, blocking=False):
-        def on_connect(sock, addr):
-            conn = GeventConnection(sock)
-            StompServer(conn, broker).drain()
-            
-        pool   = Pool(self.pool_size)
-        server = StreamServer((self.host, self.port),
-                              on_connect, spawn=pool)
+    def run_in_thread(self, fn, *args):
+        # blocks only the calling greenlet
+        return gevent.get_hub().threadpool.apply(fn, args)
+
+    def start_server(self, broker, blocking=False, listener=None,
+                     server_factory=StompServer):
+        # listener may be a socket that's already listening, e.g. one
+        # shared by forked workers (see shard.py)
+        broker.offload = self.run_in_thread
+        server = self.create_server(broker,
+                                    listener or (self.host, self.port),
+                                    server_factory)
+
+        def tick():
+            while True:
+                gevent.sleep(broker.tick_interval_secs)
+                # keep ticking, or group commit receipts and ack timeout
+                # requeues stop for good
+                try:
+                    broker.tick()
+                except Exception, e:
+                    logger.exception("broker tick failed: %s" % e)
+
+        gevent.spawn(tick)
         if blocking:
             server.serve_forever()
         else:
             server.start()
 
+    def create_server(self, broker, listener, server_factory=StompServer):
+        # server_factory(conn, broker) creates the StompServer for each
+        # client
+        def on_connect(sock, addr):
+            conn = GeventConnection(sock,
+                                    max_outbound_bytes=self.max_outbound_bytes,
+                                    policy=self.slow_consumer_policy,
+                                    stats=self.slow_consumer_stats)
+            server_factory(conn, broker).drain()
+
+        return StreamServer(listener, on_connect, spawn=Pool(self.pool_size))
+
     def start_client_sync(self):
         sock = create_connection((self.host, self.port),
                                      timeout=self.client_timeout)
         return StompClient(GeventConnection(sock, self.client_timeout))
 
+    def start_client_pool(self, size=4, **kwargs):
+        # see pool.py
+        from radiator.pool import StompClientPool
+        return StompClientPool([ (self.host, self.port) ], size,
+                               client_timeout=self.client_timeout, **kwargs)
+
     def start_client(self, cb):
         def start():
             cb(self.start_client_sync())
 
         return Greenlet.spawn(start)
 
-class GeventConnection(object):
+class GeventConnection(BufferedConnection):
 
-    def __init__(self, socket, timeout=None):
+    def __init__(self, socket, timeout=None, max_outbound_bytes=0,
+                 policy="drop-oldest", stats=None):
         self.timeout = timeout
         self.s = socket
-        self.f = self.s.makefile()
+        # frames queued by send() are written with a single sendall()
+        # once the current greenlet yields.  once max_outbound_bytes
+        # are queued the sender flushes synchronously.  outbound_bytes
+        # includes the batch currently in sendall().
+        self._init_outbound(max_outbound_bytes, policy, stats)
+        self.flusher = None
+        self.write_lock = Semaphore()
 
     def yield_(self):
         gevent.sleep(0)
 
+    def event(self):
+        # lets one greenlet wake another waiting on it, e.g. callers
+        # waiting in StompClient.call()
+        return Event()
+
     def close(self):
-        self.s.close()
-        self.s = None
-        self.f = None
+        try:
+            self.flush()
+        finally:
+            self.s.close()
+            self.s = None
+
+    def disconnect(self):
+        # shutdown rather than close so the greenlet blocked in recv()
+        # sees EOF and the session is cleaned up by drain()
+        self.closed = True
+        self._discard_outbound()
+        if self.s:
+            try:
+                self.s.shutdown(SHUT_RDWR)
+            except socket_error:
+                pass
 
-    def write(self, data):
-        self.f.write(data)
-        
     def flush(self):
-        self.f.flush()
-        
-    def read(self, num):
-        return self.f.read(num)
+        # the lock keeps batches in order when a sender hits the cap
+        # while the flusher greenlet is blocked in sendall()
+        with self.write_lock:
+            if not self.outbound:
+                return
+            data = self._take_outbound()
+            try:
+                if self.s:
+                    self.s.sendall(data)
+            except socket_error:
+                if self.max_outbound_bytes == 0:
+                    # a client has to know its frame wasn't sent, e.g.
+                    # so StompClientPool can fail over
+                    raise
+                # client went away - drain() will notice on recv
+            finally:
+                self.outbound_bytes -= len(data)
+
+    def _schedule_flush(self):
+        if not self.flusher:
+            self.flusher = gevent.spawn(self._flush_later)
+
+    def _flush_later(self):
+        self.flusher = None
+        self.flush()
 
-    def readline(self):
+    def recv(self, size=65536):
         gevent.sleep(0)
-        if self.timeout > 0:
-            with Timeout(self.timeout, False):
-                line = self.f.readline()
-                if not line:
-                    raise RadiatorTimeout
-                else:
-                    return line
-        else:
-            line = self.f.readline()
-            if not line:
-                raise BufferError
+        try:
+            if self.timeout > 0:
+                with Timeout(self.timeout, False):
+                    data = self.s.recv(size)
+                    if not data:
+                        raise BufferError
+                    return data
+                raise RadiatorTimeout
             else:
-                return line
+                data = self.s.recv(size)
+                if not data:
+                    raise BufferError
+                else:
+                    return data
+        except socket_timeout:
+            # socket level timeout given to start_client_sync()
+            raise RadiatorTimeout
+        except socket_error:
+            # reset by the peer, or shut down by disconnect()
+            raise BufferError
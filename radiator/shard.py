@@ -0,0 +1,237 @@
+#
+# Multi process broker.  serve_sharded() forks one worker per core.  All
+# workers accept clients from the same listening socket, and each runs
+# its own Broker owning the destinations whose name hashes to it.
+#
+# A client's frames for a destination owned by another worker are
+# relayed to that worker over a unix socket, with one link per client
+# and worker.  Frames coming back (MESSAGE, RECEIPT, ERROR) are passed
+# to the client unchanged.  Each link is a session on the owning
+# worker, so acks and requeue on disconnect work as they do on a single
+# broker.  Message ids carry their destination name, so ACKs are routed
+# the same way as SENDs.  Wildcard subscriptions are made on every
+# worker.  Reply-to destinations name the worker the caller is connected
+# to, so replies go back there.
+#
+# Limitation: the prefetch window is per worker, not per client.  Each
+# link (and the client's local session) has its own window, so a client
+# whose subscriptions are owned by K workers may have up to K times
+# prefetch-count messages unacked.  A wildcard subscription is made on
+# every worker, so it always counts as owned by all of them.  Sharing
+# one window would take a round trip between workers per delivery.
+#
+
+import os
+import sys
+import errno
+import signal
+import shutil
+import tempfile
+import zlib
+
+import gevent
+from gevent.socket import socket, AF_INET, AF_UNIX, SOCK_STREAM
+from gevent.socket import SOL_SOCKET, SO_REUSEADDR
+
+from radiator import REPLY_PREFIX
+from reactor import GeventConnection
+from stomp import BaseStompConnection, StompServer, encode_frame, dict_get
+
+def shard_of(dest_name, shards):
+    return (zlib.crc32(dest_name) & 0xffffffff) % shards
+
+def owner_of(dest_name, shards):
+    # REPLY_PREFIX + "<shard>.<name>", see ShardedStompServer
+    if dest_name.startswith(REPLY_PREFIX):
+        shard = dest_name[len(REPLY_PREFIX):].split(".", 1)[0]
+        if shard.isdigit():
+            return int(shard) % shards
+    return shard_of(dest_name, shards)
+
+def is_pattern(dest_name):
+    return dest_name.find("*") >= 0 or dest_name.endswith(".>")
+
+def shard_path(sock_dir, shard):
+    return os.path.join(sock_dir, "shard.%d.sock" % shard)
+
+def encode_headers(headers):
+    # content-length is added back by encode_frame()
+    return [ "%s:%s" % (k, v) for (k, v) in headers.items()
+             if k != "content-length" ]
+
+def listen(family, address, backlog=1024):
+    s = socket(family, SOCK_STREAM)
+    if family == AF_INET:
+        s.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    s.bind(address)
+    s.listen(backlog)
+    return s
+
+def serve_sharded(reactor, create_broker, workers, sock_dir=None):
+    # forks workers serving reactor.host:reactor.port and waits for
+    # them.  create_broker() is called in each worker.
+    sock_dir = sock_dir or tempfile.mkdtemp(prefix="radiator-")
+    listener = listen(AF_INET, (reactor.host, reactor.port))
+    # bound before forking so a worker never links to a socket that
+    # doesn't exist yet
+    links = [ listen(AF_UNIX, shard_path(sock_dir, i))
+              for i in range(workers) ]
+    pids = [ ]
+    for shard in range(workers):
+        pid = gevent.fork()
+        if pid == 0:
+            try:
+                for i in range(workers):
+                    if i != shard:
+                        links[i].close()
+                run_worker(reactor, create_broker(), shard, workers,
+                           sock_dir, listener, links[shard])
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    # SIGTERM stops the workers too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while pids:
+            try:
+                (pid, status) = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            pids.remove(pid)
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                # already gone
+                pass
+        shutil.rmtree(sock_dir, True)
+
+def run_worker(reactor, broker, shard, workers, sock_dir, listener,
+               link_listener):
+    # other workers' links are plain STOMP sessions
+    reactor.create_server(broker, link_listener).start()
+    factory = lambda conn, broker: ShardedStompServer(conn, broker, shard,
+                                                      workers, sock_dir)
+    reactor.start_server(broker, blocking=True, listener=listener,
+                         server_factory=factory)
+
+class ShardedStompServer(StompServer):
+
+    def __init__(self, conn, broker, shard, shards, sock_dir):
+        StompServer.__init__(self, conn, broker)
+        self.shard = shard
+        self.shards = shards
+        self.sock_dir = sock_dir
+        #
+        #   key: shard number
+        # value: ShardLink
+        self.links = { }
+
+    def _dispatch(self, frame):
+        cmd = frame["command"]
+        headers = frame["headers"]
+        if cmd == "SUBSCRIBE" or cmd == "UNSUBSCRIBE":
+            dest_name = headers["destination"]
+            if is_pattern(dest_name):
+                # the receipt comes from this worker
+                remote = frame.copy()
+                remote["headers"] = headers.copy()
+                remote["headers"].pop("receipt", None)
+                for shard in range(self.shards):
+                    if shard != self.shard:
+                        self._link(shard).forward(remote)
+                StompServer._dispatch(self, frame)
+                return
+        elif cmd == "SEND":
+            dest_name = headers["destination"]
+            if headers.has_key("reply-to") and \
+                   owner_of(dest_name, self.shards) != self.shard:
+                self._expect_reply(frame)
+        elif cmd == "ACK":
+            parts = headers.get("message-id", "").split(",", 1)
+            if len(parts) < 2:
+                # malformed, the local broker logs and ignores it
+                StompServer._dispatch(self, frame)
+                return
+            dest_name = parts[1]
+        else:
+            StompServer._dispatch(self, frame)
+            return
+        shard = owner_of(dest_name, self.shards)
+        if shard == self.shard:
+            StompServer._dispatch(self, frame)
+        else:
+            self._link(shard).forward(frame)
+
+    def _expect_reply(self, frame):
+        # the reply is routed back to this worker by its name.  a
+        # request relayed to another worker is expected there too, for
+        # the link's session, until it expires.
+        headers = frame["headers"]
+        reply_to = headers["reply-to"]
+        if reply_to.startswith(REPLY_PREFIX):
+            headers["reply-to"] = "%s%d.%s" % (REPLY_PREFIX, self.shard,
+                                               reply_to[len(REPLY_PREFIX):])
+        StompServer._expect_reply(self, frame)
+
+    def closed(self):
+        for link in self.links.values():
+            link.close()
+        self.links.clear()
+        StompServer.closed(self)
+
+    def relay(self, frame):
+        # a frame from another worker
+        headers = frame["headers"]
+        send = self.f.send
+        if frame["command"] == "MESSAGE" and \
+               dict_get(headers, "destination", "").find("/topic/") == 0:
+            send = self.f.send_lossy
+        send(frame["command"] + "\n",
+             encode_frame(encode_headers(headers), frame["body"]))
+
+    def _link(self, shard):
+        link = self.links.get(shard)
+        if not link:
+            link = ShardLink(shard_path(self.sock_dir, shard), self)
+            self.links[shard] = link
+        return link
+
+#
+# A client's connection to the worker owning some of its destinations.
+#
+class ShardLink(BaseStompConnection):
+
+    def __init__(self, path, client):
+        s = socket(AF_UNIX, SOCK_STREAM)
+        s.connect(path)
+        # writes are coalesced like a server connection's
+        BaseStompConnection.__init__(self, GeventConnection(s,
+                                         max_outbound_bytes=1048576))
+        self.client = client
+        self.connected = True
+        self._write_frame("CONNECT")
+        self.reader = gevent.spawn(self._read)
+
+    def forward(self, frame):
+        self._write_frame(frame["command"],
+                          headers=encode_headers(frame["headers"]),
+                          body=frame["body"])
+
+    def close(self):
+        # the owning worker ends the link's session when it sees EOF
+        self.connected = False
+        self.f.flush()
+        self.f.disconnect()
+
+    def _read(self):
+        self.drain()
+        self.f.close()
+
+    def _dispatch(self, frame):
+        if frame["command"] != "CONNECTED":
+            self.client.relay(frame)
@@ -1,7 +1,10 @@
 import uuid
 import time
+import heapq
+from collections import deque
 
-from radiator import RadiatorTimeout
+from radiator import RadiatorTimeout, RadiatorQueueFull, RadiatorError
+from radiator import REPLY_PREFIX, topic_matches
 
 def dict_get(d, key, default_val):
     if d.has_key(key):
@@ -9,8 +12,133 @@ def dict_get(d, key, default_val):
     else:
         return default_val
 
+# SEND headers that aren't passed on to subscribers.  the ones the
+# broker sets on MESSAGE frames are dropped so a producer can't override
+# them.
+BROKER_HEADERS = ("destination", "receipt", "content-length", "transaction",
+                  "message-id", "subscription")
+
+def message_headers(frame_headers):
+    # headers of a SEND in the form the broker stores them (see
+    # radiator.Message), e.g. reply-to and correlation-id
+    return "\n".join([ "%s:%s" % (k, v) for (k, v) in frame_headers.items()
+                       if k.lower() not in BROKER_HEADERS ])
+
+#
+# Incremental STOMP frame parser.  feed() takes whatever the socket
+# returned and hands back every frame completed by it.  Terminators are
+# located with str.find() over the whole buffer instead of reading a
+# line or a byte at a time.
+#
+class FrameParser(object):
+
+    def __init__(self):
+        self.chunks   = [ ]
+        self.buffered = 0
+        # don't try to parse again until this many bytes are buffered
+        self.needed   = 0
+
+    def feed(self, data):
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if self.buffered < self.needed:
+            return [ ]
+        buf = "".join(self.chunks)
+        frames = [ ]
+        pos = 0
+        while True:
+            frame = self._parse(buf, pos)
+            if not frame:
+                break
+            (frame, pos) = frame
+            frames.append(frame)
+        buf = buf[pos:]
+        self.chunks   = [ buf ]
+        self.buffered = len(buf)
+        return frames
+
+    def _parse(self, buf, start):
+        # skip EOLs between frames
+        pos = start
+        size = len(buf)
+        while pos < size and buf[pos] in "\r\n":
+            pos += 1
+        if pos >= size:
+            self.needed = 0
+            return None
+
+        # command and headers end with an empty line
+        end = buf.find("\n\n", pos)
+        # only look for CRLF as far as the LF frame end, otherwise a
+        # buffer of many frames is scanned to the end for every frame
+        if end >= 0:
+            end_crlf = buf.find("\n\r\n", pos, end + 2)
+        else:
+            end_crlf = buf.find("\n\r\n", pos)
+        if end_crlf >= 0 and (end < 0 or end_crlf < end):
+            body_start = end_crlf + 3
+            end = end_crlf
+        elif end >= 0:
+            body_start = end + 2
+        else:
+            self.needed = size - start + 1
+            return None
+        lines = buf[pos:end].split("\n")
+        frame = { "command" : lines[0].strip(), "headers" : { } }
+        content_length = 0
+        for line in lines[1:]:
+            i = line.find(":")
+            if i >= 0:
+                key = line[:i].strip()
+                val = line[(i+1):].strip()
+                frame["headers"][key] = val
+                if key.lower() == "content-length":
+                    content_length = int(val)
+
+        # read body
+        if content_length > 0:
+            body_end = body_start + content_length
+            nul = buf.find(chr(0), body_end)
+            if nul < 0:
+                self.needed = max(body_end, size) - start + 1
+                return None
+            frame["body"] = buf[body_start:body_end]
+        else:
+            nul = buf.find(chr(0), body_start)
+            if nul < 0:
+                self.needed = size - start + 1
+                return None
+            frame["body"] = buf[body_start:nul].rstrip("\n").rstrip("\r")
+        self.needed = 0
+        return (frame, nul + 1)
+
+#
+# Encodes everything after the command line of a frame.  Kept apart from
+# the command so a MESSAGE frame can be encoded once and sent to many
+# subscribers with only the first line differing.
+#
+def encode_frame(headers=None, body=None):
+    parts = [ ]
+    if headers:
+        for h in headers:
+            parts.append(h)
+            parts.append("\n")
+    if body:
+        parts.append("content-length:%d\n\n" % len(body))
+        parts.append(body)
+    else:
+        parts.append("\n")
+    parts.append(chr(0))
+    return "".join(parts)
+
 class BaseStompConnection(object):
 
+    def __init__(self, conn):
+        self.f = conn
+        self.parser = FrameParser()
+        # frames parsed but not dispatched yet
+        self.frames = deque()
+
     def drain(self, max=0, timeout=-1):
         i = 0
         self.f.timeout = timeout
@@ -28,81 +156,105 @@ class BaseStompConnection(object):
                 break
         return i
 
+    def feed(self, data):
+        # push style alternative to drain(), for reactors that hand over
+        # bytes as they arrive instead of blocking in recv()
+        self.frames.extend(self.parser.feed(data))
+        while self.connected and self.frames:
+            self._dispatch(self.frames.popleft())
+
     def _write_frame(self, command, headers=None, body=None):
         #print "SEND: command=%s headers=%s body=%s" % \
         #      (command, str(headers), str(body))
-        if body:
-            headers.append("content-length:%d" % len(body))        
-        f = self.f
-        f.write(command)
-        f.write("\n")
-        if headers:
-            for h in headers:
-                f.write(h)
-                f.write("\n")
-        f.write("\n")
-        if body:
-            f.write(body)
-        f.write(chr(0))
-        f.flush()
+        # the connection coalesces the frame with other queued frames
+        # into a single socket write
+        self.f.send(command + "\n", encode_frame(headers, body))
 
     def _read_frame(self, timeout=-1):
         self.timeout = timeout
-        
-        frame = { "headers" : { } }
-
-        # command is first
-        frame["command"] = self._readline().strip()
-        
-        # read headers
-        content_length = 0
-        line = self._readline()
-        while line.strip() != "":
-            pos = line.find(":")
-            if pos >= 0:
-                key = line[:pos].strip()
-                val = line[(pos+1):].strip()
-                frame["headers"][key] = val
-                if key.lower() == "content-length":
-                    content_length = int(val)
-            line = self._readline()
-                
-        # read body
-        if content_length > 0:
-            frame["body"] = self.f.read(content_length)
-            while True:
-                if self.f.read(1) == chr(0): break
-        else:
-            body = [ ]
-            c = self.f.read(1)
-            while c != chr(0):
-                body.append(c)
-                c = self.f.read(1)
-            frame["body"] = "".join(body).rstrip("\n").rstrip("\r")
-
+        # a single recv may complete several frames
+        while not self.frames:
+            self.frames.extend(self.parser.feed(self.f.recv()))
+        frame = self.frames.popleft()
         #print "RECV: command=%s headers=%s body=%s" % \
         #      (frame["command"], frame["headers"], frame["body"])
         return frame
 
-    def _readline(self):
-        line = self.f.readline()
-        if line:
-            return line
-        else:
-            raise RadiatorTimeout
-    
 
 def on_error_default(err_message, body):
     print "STOMP error: %s %s" % (err_message, str(body))
 
+#
+# A frame sent with a receipt header, until the broker confirms it (see
+# StompClient.send_async)
+#
+class PendingReceipt(object):
+
+    __slots__ = ("client", "id", "on_receipt", "done", "error")
+
+    def __init__(self, client, id, on_receipt=None):
+        self.client = client
+        self.id = id
+        # called with (client, receipt id, error) once the RECEIPT or an
+        # ERROR for it arrives.  error is None for a RECEIPT.
+        self.on_receipt = on_receipt
+        self.done = False
+        self.error = None
+
+    def wait(self, timeout_sec=60):
+        # reads from the connection until this receipt arrives.  raises
+        # IOError if it doesn't, or RadiatorError if the broker sent an
+        # ERROR instead.
+        self.client._wait_for_receipt(self, timeout_sec)
+
+#
+# A StompClient.call() waiting for its reply
+#
+class PendingCall(object):
+
+    __slots__ = ("correlation_id", "deadline", "event", "reply")
+
+    def __init__(self, correlation_id, deadline, event):
+        self.correlation_id = correlation_id
+        self.deadline = deadline
+        # set once the reply arrives, the call times out, or the caller
+        # should take over reading from the connection
+        self.event = event
+        self.reply = None
+
 class StompClient(BaseStompConnection):
 
-    def __init__(self, conn, on_error=None, write_timeout=60):
-        self.f = conn
+    def __init__(self, conn, on_error=None, write_timeout=60,
+                 receipt_window=1000):
+        BaseStompConnection.__init__(self, conn)
+        # how long a frame sent with receipt=True waits for its receipt
         self.write_timeout = write_timeout
         self.on_error = on_error or on_error_default
         self.callbacks = { }
-        self.receipts  = [ ]
+        #
+        # receipts not received yet
+        #   key: receipt id
+        # value: PendingReceipt
+        self.receipts  = { }
+        # most receipts outstanding before send_async() stops to read
+        # some of them.  the broker stops reading from a client that
+        # doesn't read what it's sent, so this can't be unbounded.
+        self.receipt_window = receipt_window
+        # receipt ids only need to be unique per connection
+        self.last_receipt_id = 0
+        # headers of the MESSAGE being dispatched to a callback, e.g. to
+        # pass to reply()
+        self.message_headers = { }
+        #
+        # outstanding call()s
+        #   key: correlation-id
+        # value: PendingCall
+        self.calls = { }
+        # (deadline, correlation-id) per outstanding call
+        self.call_deadlines = [ ]
+        # True while one of the callers in call() reads from the
+        # connection on behalf of all of them
+        self.reading_replies = False
         self.connect()
 
     def connect(self):
@@ -122,65 +274,102 @@ class StompClient(BaseStompConnection):
 
     def call(self, dest_name, body, timeout=60, call_sleep_sec=0.005,
              headers=None, receipt=False):
-        resp_body = [ ]
-        def on_msg(s, m_id, r_body):
-            resp_body.append(r_body)
-            
-        reply_to_id = uuid.uuid4().hex
-        if not headers:
-            headers = { }
-        headers['reply-to'] = reply_to_id
-        self.callbacks[reply_to_id] = on_msg
+        # sends body with reply-to and correlation-id headers and
+        # returns the body of the reply (see reply()).  Any number of
+        # greenlets may call() on one connection at once.  Whichever of
+        # them isn't waiting on another reads frames for all of them, so
+        # don't drain() this client elsewhere while calls are
+        # outstanding.  call_sleep_sec is no longer used.
+        call = PendingCall(uuid.uuid4().hex, time.time() + timeout,
+                           self.f.event())
+        self.calls[call.correlation_id] = call
+        heapq.heappush(self.call_deadlines,
+                       (call.deadline, call.correlation_id))
+        # the broker delivers the reply to this connection and forgets
+        # the reply-to destination once it arrives or expires
+        headers = dict(headers or { })
+        headers["reply-to"] = REPLY_PREFIX + call.correlation_id
+        headers["correlation-id"] = call.correlation_id
+        headers["expires"] = "%d" % (call.deadline * 1000)
         self.send(dest_name, body, headers, receipt)
-        timeout_sec = time.time() + timeout
-        while time.time() < timeout_sec and len(resp_body) == 0:
-            time.sleep(self.call_sleep_sec)
-        if resp_body:
-            return resp_body[0]
-        else:
+        self._wait_for_reply(call)
+        if call.reply is None:
             raise RadiatorTimeout("No response to message: %s within timeout: %.1f" % \
                                   (body, timeout))
+        return call.reply
+
+    def reply(self, request_headers, body, receipt=False):
+        # answers a message sent by call().  request_headers are the
+        # headers of that message, see message_headers.
+        self.send(request_headers["reply-to"], body,
+                  { "correlation-id" : request_headers["correlation-id"] },
+                  receipt)
 
     def send(self, dest_name, body, headers=None, receipt=False):
-        headers_arr = [ "destination:%s" % dest_name ]
-        if headers:
-            for k,v in headers.items():
-                headers_arr.append("%s:%s" % (k, v))
-        r = None
+        # with receipt=True, blocks until the broker has the message
         if receipt:
-            r = self._create_receipt(headers)
+            self.send_async(dest_name, body, headers).wait(self.write_timeout)
+        else:
+            self._write_frame("SEND", headers=self._send_headers(dest_name,
+                                                                 headers),
+                              body=body)
+
+    def send_async(self, dest_name, body, headers=None, on_receipt=None):
+        # sends with a receipt header without waiting for it and returns
+        # the PendingReceipt.  receipts are read as they arrive, by
+        # drain() or whatever else reads from this client, or with
+        # wait_for_receipts().
+        headers_arr = self._send_headers(dest_name, headers)
+        pending = self._create_receipt(headers_arr, on_receipt)
         self._write_frame("SEND", headers=headers_arr, body=body)
-        if receipt: self._wait_for_receipt(r)
+        return pending
 
-    def subscribe(self, dest_name, callback, auto_ack=True, receipt=False):
+    def wait_for_receipts(self, timeout_sec=60, outstanding=0):
+        # reads until at most outstanding receipts are still to come
+        timeout = time.time() + timeout_sec
+        while len(self.receipts) > outstanding and self.connected:
+            remaining = timeout - time.time()
+            if remaining <= 0:
+                break
+            self.drain(max=1, timeout=remaining)
+        if len(self.receipts) > outstanding:
+            raise IOError("%d receipts not received after %d seconds" %
+                          (len(self.receipts), timeout_sec))
+
+    def subscribe(self, dest_name, callback, auto_ack=True, receipt=False,
+                  prefetch_count=None):
         ack = "client"
         if auto_ack: ack = "auto"
         headers = [ "destination:%s" % dest_name, "ack:%s" % ack ]
-        headers = self._create_headers(receipt, headers)
-        self._write_frame("SUBSCRIBE", headers=headers)
-        if receipt: self._wait_for_receipt(headers['receipt'])
+        if prefetch_count:
+            headers.append("prefetch-count:%d" % prefetch_count)
+        # messages may arrive before the receipt
         self.callbacks[dest_name] = callback
+        self._write_with_receipt("SUBSCRIBE", headers, receipt)
 
     def unsubscribe(self, dest_name, receipt=False):
-        headers = self._create_headers(receipt, ["destination:%s" % dest_name])
-        self._write_frame("UNSUBSCRIBE", headers=headers)
-        if receipt: self._wait_for_receipt(headers['receipt'])
+        self._write_with_receipt("UNSUBSCRIBE",
+                                 ["destination:%s" % dest_name], receipt)
         self.drain(timeout=0.1)
         if self.callbacks.has_key(dest_name):
             del(self.callbacks[dest_name])
 
     def ack(self, msg_id, receipt=False):
-        headers = self._create_headers(receipt, ["message-id:%s" % msg_id])
+        self._write_with_receipt("ACK", ["message-id:%s" % msg_id], receipt)
+
+    def ack_async(self, msg_id, on_receipt=None):
+        # like send_async()
+        headers = ["message-id:%s" % msg_id]
+        pending = self._create_receipt(headers, on_receipt)
         self._write_frame("ACK", headers=headers)
-        if receipt: self._wait_for_receipt(headers['receipt'])
+        return pending
 
     def _dispatch(self, frame):
         headers = frame["headers"]
         cmd = frame["command"]
         if   cmd == "MESSAGE"  : self._on_message(frame)
-        elif cmd == "RECEIPT"  : self.receipts.append((headers["receipt"]))
-        elif cmd == "ERROR"    : self.on_error(headers["message"],
-                                               dict_get(frame, "body", ""))
+        elif cmd == "RECEIPT"  : self._on_receipt(headers["receipt"])
+        elif cmd == "ERROR"    : self._on_error(frame)
         else:
             print "Unknown command: %s" % cmd
 
@@ -188,43 +377,161 @@ class StompClient(BaseStompConnection):
         dest_name  = frame["headers"]["destination"]
         message_id = frame["headers"]["message-id"]
         body = dict_get(frame, "body", "")
-        if self.callbacks.has_key(dest_name):
+        if dest_name.startswith(REPLY_PREFIX):
+            self._on_reply(frame["headers"], body)
+        elif self.callbacks.has_key(dest_name):
+            self.message_headers = frame["headers"]
             self.callbacks[dest_name](self, message_id, body)
         else:
             self.on_error("No subscriber registered for destination: " +
                           "%s - but got message: %s %s" %
                           (dest_name, message_id, body))
             
-    def _create_headers(self, receipt, headers):
-        if receipt:
-            headers.append("receipt:%s" % uuid.uuid4().hex)
-        return headers
+    def _on_reply(self, headers, body):
+        # replies that come after their call timed out are dropped
+        correlation_id = dict_get(headers, "correlation-id", "")
+        call = self.calls.pop(correlation_id, None)
+        if call:
+            call.reply = body
+            call.event.set()
+
+    def _wait_for_reply(self, call):
+        # leader/follower: one caller reads until the earliest deadline
+        # of all outstanding calls, the rest wait on their event
+        while call.reply is None and self.connected and \
+                  self.calls.has_key(call.correlation_id):
+            if self.reading_replies:
+                call.event.wait(max(0, call.deadline - time.time()))
+                call.event.clear()
+                if time.time() >= call.deadline:
+                    self._expire_calls()
+                continue
+            self.reading_replies = True
+            try:
+                # leaves the earliest live deadline on top of the heap
+                self._expire_calls()
+                if self.calls.has_key(call.correlation_id):
+                    timeout = self.call_deadlines[0][0] - time.time()
+                    self.drain(max=1, timeout=max(0.001, timeout))
+            finally:
+                self.reading_replies = False
+                self._wake_next_reader(call)
+        # no longer outstanding if it timed out or the connection closed
+        self.calls.pop(call.correlation_id, None)
+        if not self.connected:
+            for other in self.calls.values():
+                other.event.set()
+
+    def _expire_calls(self):
+        now = time.time()
+        deadlines = self.call_deadlines
+        while deadlines and (deadlines[0][0] <= now or
+                             not self.calls.has_key(deadlines[0][1])):
+            (deadline, correlation_id) = heapq.heappop(deadlines)
+            call = self.calls.pop(correlation_id, None)
+            if call:
+                call.event.set()
+
+    def _wake_next_reader(self, done):
+        # hands reading over to another caller still waiting
+        for (deadline, correlation_id) in self.call_deadlines:
+            call = self.calls.get(correlation_id)
+            if call and call is not done:
+                call.event.set()
+                return
+
+    def _on_receipt(self, receipt_id, error=None):
+        pending = self.receipts.pop(receipt_id, None)
+        if not pending:
+            return False
+        pending.done  = True
+        pending.error = error
+        if pending.on_receipt:
+            pending.on_receipt(self, receipt_id, error)
+        return True
+
+    def _on_error(self, frame):
+        # an ERROR for a frame sent with send_async() goes to its
+        # on_receipt callback if it has one
+        headers = frame["headers"]
+        pending = self.receipts.get(dict_get(headers, "receipt-id", None))
+        if pending:
+            self._on_receipt(pending.id, headers["message"])
+            if pending.on_receipt:
+                return
+        self.on_error(headers["message"], dict_get(frame, "body", ""))
 
-    def _create_receipt(self, headers):
-        receipt = uuid.uuid4().hex
-        headers.append("receipt:%s" % receipt)
-        return receipt
+    def _send_headers(self, dest_name, headers):
+        headers_arr = [ "destination:%s" % dest_name ]
+        if headers:
+            for k,v in headers.items():
+                headers_arr.append("%s:%s" % (k, v))
+        return headers_arr
 
-    def _wait_for_receipt(self, receipt, timeout_sec=60):
+    def _write_with_receipt(self, command, headers, receipt):
+        pending = None
+        if receipt:
+            pending = self._create_receipt(headers)
+        self._write_frame(command, headers=headers)
+        if pending:
+            pending.wait(self.write_timeout)
+
+    def _create_receipt(self, headers, on_receipt=None):
+        if len(self.receipts) >= self.receipt_window:
+            # read receipts in batches of half the window
+            self.wait_for_receipts(self.write_timeout,
+                                   self.receipt_window / 2)
+        self.last_receipt_id += 1
+        pending = PendingReceipt(self, "%d" % self.last_receipt_id,
+                                 on_receipt)
+        self.receipts[pending.id] = pending
+        headers.append("receipt:%s" % pending.id)
+        return pending
+
+    def _wait_for_receipt(self, pending, timeout_sec=60):
         timeout = time.time() + timeout_sec
-        while time.time() > timeout:
-            self.drain(timeout=.05)
-            if receipt in self.receipts:
-                self.receipts.remove(receipt)
-                return
-        raise IOError("No receipt %s received after %d seconds" %
-                      (receipt, timeout_sec))
+        while not pending.done and self.connected:
+            remaining = timeout - time.time()
+            if remaining <= 0:
+                break
+            self.drain(max=1, timeout=remaining)
+        if not pending.done:
+            raise IOError("No receipt %s received after %d seconds" %
+                          (pending.id, timeout_sec))
+        if pending.error:
+            raise RadiatorError("ERROR instead of receipt %s: %s" %
+                          (pending.id, pending.error))
 
 class StompServer(BaseStompConnection):
 
     def __init__(self, conn, broker):
-        self.f = conn
+        BaseStompConnection.__init__(self, conn)
         self.broker = broker
         self.connected = True
+        # set by CONNECT
+        self.session_id = None
+        #
+        #   key: dest_name
+        # value: id header given to SUBSCRIBE
+        self.subscription_ids = { }
+        #
+        # id of the subscription a destination without its own
+        # subscription was matched by, or None.  filled by _on_message.
+        #
+        #   key: dest_name
+        # value: id header given to SUBSCRIBE, or None
+        self.matched_ids = { }
 
     def drain(self):
         # read all messages from this client
-        BaseStompConnection.drain(self)
+        try:
+            BaseStompConnection.drain(self)
+        finally:
+            self.closed()
+
+    def closed(self):
+        # write anything still queued for the client (e.g. receipts)
+        self.f.flush()
         # connection ended - notify broker to remove
         self.broker.destroy_session(self.session_id)
 
@@ -245,23 +552,72 @@ class StompServer(BaseStompConnection):
                           headers=[ "session:%s" % self.session_id.hex ])
 
     def _send(self, frame):
-        self.broker.send(frame["headers"]["destination"], frame["body"])
-        self._send_receipt(frame)
+        # SENDs to the same destination that arrived in the same read
+        # are appended to the queue together
+        dest_name = frame["headers"]["destination"]
+        frames = [ frame ]
+        while self.frames and self.frames[0]["command"] == "SEND" and \
+                  dict_get(self.frames[0]["headers"], "destination",
+                           None) == dest_name:
+            frames.append(self.frames.popleft())
+        for f in frames:
+            if f["headers"].has_key("reply-to"):
+                self._expect_reply(f)
+        # with group commit enabled the receipts are held back until
+        # the messages have been fsynced
+        bodies = [ f["body"] for f in frames ]
+        headers = [ message_headers(f["headers"]) for f in frames ]
+        try:
+            self.broker.send_many(dest_name, bodies,
+                                  lambda: self._send_receipts(frames),
+                                  headers)
+        except RadiatorQueueFull, e:
+            # not enough room for all of them - only fail the ones
+            # that don't fit
+            for (f, h) in zip(frames, headers):
+                try:
+                    self.broker.send(dest_name, f["body"],
+                                     lambda f=f: self._send_receipt(f), h)
+                except RadiatorQueueFull, e:
+                    self._send_error(str(e), f)
+
+    def _expect_reply(self, frame):
+        # replies to this request come straight back to this client
+        reply_to = frame["headers"]["reply-to"]
+        if reply_to.startswith(REPLY_PREFIX):
+            expires = dict_get(frame["headers"], "expires", "")
+            if expires.isdigit():
+                expires = int(expires)
+            else:
+                expires = None
+            self.broker.expect_reply(reply_to, self._on_message, expires)
 
     def _subscribe(self, frame):
-        cb = lambda dest_name, msg_id, body: self._on_message(dest_name,
-                                                              msg_id,
-                                                              body)
+        cb = lambda dest_name, msg_id, body, headers="": \
+             self._on_message(dest_name, msg_id, body, headers)
         auto_ack = not dict_get(frame["headers"], "ack", "") == "client"
+        prefetch_count = dict_get(frame["headers"], "prefetch-count", "")
+        if prefetch_count.isdigit():
+            prefetch_count = int(prefetch_count)
+        else:
+            prefetch_count = None
+        if frame["headers"].has_key("id"):
+            self.subscription_ids[frame["headers"]["destination"]] = \
+                frame["headers"]["id"]
+            self.matched_ids.clear()
         self.broker.subscribe(frame["headers"]["destination"],
                               auto_ack,
                               self.session_id,
-                              cb)
+                              cb,
+                              prefetch_count)
         self._send_receipt(frame)
 
     def _unsubscribe(self, frame):
-        self.broker.unsubscribe(frame["headers"]["destination"],
-                                self.session_id)
+        dest_name = frame["headers"]["destination"]
+        if self.subscription_ids.has_key(dest_name):
+            del(self.subscription_ids[dest_name])
+            self.matched_ids.clear()
+        self.broker.unsubscribe(dest_name, self.session_id)
         self._send_receipt(frame)
 
     def _ack(self, frame):
@@ -271,15 +627,57 @@ class StompServer(BaseStompConnection):
     def _disconnect(self, frame):
         self.connected = False
 
-    def _on_message(self, dest_name, message_id, body):
+    def _on_message(self, dest_name, message_id, body, headers=""):
         #print "_on_message: %s %s %s" % (dest_name, message_id, body)
-        self._write_frame("MESSAGE", body=body,
-                          headers=["destination:%s" % dest_name,
-                                   "message-id:%s" % message_id])
+        # a topic delivers each message to all its subscribers back to
+        # back, so every subscriber after the first reuses the frame
+        # encoded for the first (see Broker.fanout_cache)
+        cache = self.broker.fanout_cache
+        encoded = cache.get(message_id)
+        if encoded is None:
+            frame_headers = [ "destination:%s" % dest_name,
+                              "message-id:%s" % message_id ]
+            if headers:
+                frame_headers.append(headers)
+            encoded = encode_frame(frame_headers, body)
+            if dest_name.find("/topic/") == 0:
+                cache[message_id] = encoded
+        # topic messages may be dropped if this client can't keep up
+        send = self.f.send
+        if dest_name.find("/topic/") == 0:
+            send = self.f.send_lossy
+        sub_id = self._subscription_id(dest_name)
+        if sub_id is not None:
+            send("MESSAGE\nsubscription:%s\n" % sub_id, encoded)
+        else:
+            send("MESSAGE\n", encoded)
+
+    def _subscription_id(self, dest_name):
+        if self.subscription_ids.has_key(dest_name):
+            return self.subscription_ids[dest_name]
+        if not self.matched_ids.has_key(dest_name):
+            # delivered through a wildcard subscription
+            sub_id = None
+            for (pattern, id) in self.subscription_ids.items():
+                if topic_matches(pattern, dest_name):
+                    sub_id = id
+                    break
+            self.matched_ids[dest_name] = sub_id
+        return self.matched_ids[dest_name]
+
+    def _send_error(self, message, frame):
+        headers = [ "message:%s" % message ]
+        if frame["headers"].has_key("receipt"):
+            headers.append("receipt-id:%s" % frame["headers"]["receipt"])
+        self._write_frame("ERROR", headers=headers)
+
+    def _send_receipts(self, frames):
+        for frame in frames:
+            self._send_receipt(frame)
 
     def _send_receipt(self, frame):
         fh = frame["headers"]
-        if fh.has_key("receipt"):
+        if fh.has_key("receipt") and self.connected:
             self._write_frame("RECEIPT",
                               headers=["receipt:%s" % fh["receipt"]])
 
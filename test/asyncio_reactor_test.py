@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import unittest
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__) + os.sep + "..")
+
+import radiator
+from radiator.stomp import FrameParser
+from radiator.asyncio_reactor import asyncio, AsyncioConnection
+from radiator.asyncio_reactor import AsyncioReactor
+
+class RecordingTransport(object):
+
+    def __init__(self):
+        self.written = [ ]
+        self.closed  = False
+        self.buffered = 0
+
+    def write(self, data):
+        self.written.append(data)
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def close(self):
+        self.closed = True
+
+    abort = close
+
+class AsyncioConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.broker = radiator.Broker()
+        self.transport = RecordingTransport()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def connect(self, **kwargs):
+        conn = AsyncioConnection(self.broker, loop=self.loop, **kwargs)
+        conn.connection_made(self.transport)
+        conn.data_received("CONNECT\n\n\x00")
+        return conn
+
+    def run_once(self):
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+
+    def test_frames_written_once_per_callback(self):
+        conn = self.connect(max_outbound_bytes=1024)
+        conn.data_received("SEND\ndestination:/memqueue/a\nreceipt:1\n\n"
+                           "hello\x00SUBSCRIBE\ndestination:/memqueue/a\n"
+                           "receipt:2\n\n\x00")
+        self.assertEquals([ ], self.transport.written)
+        self.run_once()
+        self.assertEquals(1, len(self.transport.written))
+        frames = FrameParser().feed(self.transport.written[0])
+        self.assertEquals(["CONNECTED", "RECEIPT", "MESSAGE", "RECEIPT"],
+                          [ f["command"] for f in frames ])
+        self.assertEquals("hello", frames[2]["body"])
+
+    def test_disconnect_frame_ends_session(self):
+        conn = self.connect()
+        conn.data_received("SUBSCRIBE\ndestination:/memqueue/a\n\n\x00")
+        self.assertEquals(1, len(self.broker.session_dict))
+        conn.data_received("DISCONNECT\n\n\x00")
+        self.assertTrue(self.transport.closed)
+        conn.connection_lost(None)
+        self.assertEquals(0, len(self.broker.session_dict))
+
+    def test_slow_consumer_drop_newest(self):
+        conn = self.connect(max_outbound_bytes=10, policy="drop-newest")
+        self.run_once()
+        # the transport is still holding earlier writes
+        self.transport.buffered = 6
+        conn.send_lossy("aaaa")
+        conn.send_lossy("bbbb")
+        self.assertEquals(1, conn.stats["dropped_newest"])
+        self.run_once()
+        self.assertEquals("aaaa", self.transport.written[-1])
+
+    def test_tick_continues_after_error(self):
+        ticks = [ ]
+        def tick():
+            ticks.append(1)
+            if len(ticks) == 1:
+                raise IOError("disk full")
+        self.broker.tick = tick
+        reactor = AsyncioReactor("127.0.0.1", 0, loop=self.loop)
+        reactor.start_server(self.broker)
+        self.loop.run_until_complete(asyncio.sleep(0.1, loop=self.loop))
+        reactor.server.close()
+        self.assertTrue(len(ticks) > 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#
+# FileQueue micro benchmark
+#   - send / receive / ack throughput for small messages
+#   - send_many throughput in batches of 100
+#   - compression ratio and throughput for 4KB JSON bodies
+#   - memory held by msgs_in_use per in flight message
+#
+# usage: bench_file_queue.py [msg_count]
+#
+
+import os
+import sys
+import time
+import tempfile
+import shutil
+import json
+sys.path.insert(0, os.path.dirname(__file__) + os.sep + "..")
+
+import radiator
+
+def deep_size(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += deep_size(obj.__dict__, seen)
+    for name in getattr(type(obj), "__slots__", ()):
+        if hasattr(obj, name):
+            size += deep_size(getattr(obj, name), seen)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += deep_size(k, seen) + deep_size(v, seen)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            size += deep_size(v, seen)
+    return size
+
+def bench(msg_count):
+    dir = tempfile.mkdtemp()
+    try:
+        # fsync is measured by the scenarios, not here
+        q = radiator.FileQueue("bench", dir=dir, fsync_millis=60000)
+        body = "x" * 100
+
+        start = time.time()
+        for i in xrange(msg_count):
+            q.send(body)
+        send_secs = time.time() - start
+
+        start = time.time()
+        for i in xrange(msg_count):
+            q.receive(False)
+        receive_secs = time.time() - start
+
+        in_use_bytes = deep_size(q.msgs_in_use, set())
+
+        start = time.time()
+        for msg_header in q.msgs_in_use.values():
+            q.ack(msg_header.id)
+        ack_secs = time.time() - start
+
+        print "send:    %8d msgs/sec" % (msg_count / send_secs)
+        print "receive: %8d msgs/sec" % (msg_count / receive_secs)
+        print "ack:     %8d msgs/sec" % (msg_count / ack_secs)
+        print "msgs_in_use: %d bytes per in flight message" % \
+              (in_use_bytes / msg_count)
+        q.destroy()
+
+        q = radiator.FileQueue("bench_many", dir=dir, fsync_millis=60000)
+        batch = [ body ] * 100
+        start = time.time()
+        for i in xrange(msg_count / len(batch)):
+            q.send_many(batch)
+        print "send_many: %6d msgs/sec" % (msg_count / (time.time() - start))
+        q.destroy()
+    finally:
+        shutil.rmtree(dir)
+
+def bench_compression(msg_count):
+    body = json.dumps([ { "id" : i, "name" : "user %d" % i,
+                          "email" : "user%d@example.com" % i,
+                          "tags" : [ "a", "b", "c" ] }
+                        for i in range(50) ])
+    for compress in (False, True):
+        dir = tempfile.mkdtemp()
+        try:
+            q = radiator.FileQueue("bench", dir=dir, fsync_millis=60000,
+                                   compress_files=compress,
+                                   body_cache_bytes=0)
+            start = time.time()
+            for i in xrange(msg_count):
+                q.send(body)
+            send_secs = time.time() - start
+            ratio = float(q.disk_usage()) / (msg_count * len(body))
+
+            start = time.time()
+            for i in xrange(msg_count):
+                q.receive(True)
+            receive_secs = time.time() - start
+
+            print "compress_files=%s: ratio %.2f send %d msgs/sec " \
+                  "receive %d msgs/sec" % \
+                  (compress, ratio, msg_count / send_secs,
+                   msg_count / receive_secs)
+            q.destroy()
+        finally:
+            shutil.rmtree(dir)
+
+if __name__ == "__main__":
+    msg_count = 100000
+    if len(sys.argv) > 1:
+        msg_count = int(sys.argv[1])
+    bench(msg_count)
+    bench_compression(msg_count / 10)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# Reactor benchmark
+#   - runs the server on GeventReactor and on AsyncioReactor in turn,
+#     each in its own process
+#   - the same gevent clients publish to a memory queue and consume
+#     from it, reporting throughput and delivery latency
+#
+# usage: bench_reactors.py [msg_count] [gevent|asyncio|uvloop ...]
+#
+
+import os
+import sys
+import time
+import subprocess
+sys.path.insert(0, os.path.dirname(__file__) + os.sep + "..")
+
+import gevent
+import radiator
+from radiator.reactor import GeventReactor
+
+PORT = 61615
+
+def serve(name):
+    broker = radiator.Broker()
+    if name == "gevent":
+        reactor = GeventReactor("127.0.0.1", PORT)
+    else:
+        from radiator.asyncio_reactor import AsyncioReactor
+        reactor = AsyncioReactor("127.0.0.1", PORT,
+                                 use_uvloop=(name == "uvloop"))
+    reactor.start_server(broker, blocking=True)
+
+def wait_for_server(client_reactor):
+    for i in range(100):
+        try:
+            return client_reactor.start_client_sync()
+        except IOError:
+            time.sleep(0.05)
+    raise IOError("server didn't start")
+
+def bench(name, msg_count):
+    server = subprocess.Popen([ sys.executable, __file__, "serve", name ])
+    try:
+        reactor = GeventReactor("127.0.0.1", PORT, client_timeout=1)
+        consumer = wait_for_server(reactor)
+        producer = reactor.start_client_sync()
+        latencies = [ ]
+        def on_msg(c, msg_id, body):
+            latencies.append(time.time() - float(body.split(" ")[0]))
+        # subscribed before anything is sent, or the consumer may only
+        # get the first message of the backlog
+        consumer.subscribe("/memqueue/bench", on_msg, receipt=True,
+                           prefetch_count=100)
+
+        def produce():
+            padding = "x" * 100
+            for i in xrange(msg_count):
+                producer.send("/memqueue/bench",
+                              "%.6f %s" % (time.time(), padding))
+                if i % 100 == 0:
+                    gevent.sleep(0)
+
+        def consume():
+            while len(latencies) < msg_count:
+                if consumer.drain(timeout=1) == 0:
+                    break
+
+        start = time.time()
+        gevent.joinall([ gevent.spawn(produce), gevent.spawn(consume) ])
+        secs = time.time() - start
+        latencies.sort()
+        n = len(latencies)
+        print "%-8s %8d msgs/sec  latency ms: p50 %.2f p99 %.2f  (%d/%d)" % \
+              (name, n / secs, latencies[n / 2] * 1000,
+               latencies[int(n * 0.99)] * 1000, n, msg_count)
+        producer.disconnect()
+        consumer.disconnect()
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "serve":
+        serve(sys.argv[2])
+        sys.exit(0)
+    msg_count = 20000
+    if len(sys.argv) > 1:
+        msg_count = int(sys.argv[1])
+    names = sys.argv[2:] or [ "gevent", "asyncio" ]
+    for name in names:
+        bench(name, msg_count)
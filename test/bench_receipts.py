@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+# Confirmed send benchmark
+#   - one client sends to a queue with no receipts, then waiting for
+#     each receipt, then with receipts pipelined by send_async()
+#   - reports throughput for each
+#
+# usage: bench_receipts.py [msg_count] [dest_name]
+#
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(__file__) + os.sep + "..")
+
+import radiator
+from radiator.reactor import GeventReactor
+
+PORT = 61617
+
+def fire_and_forget(client, dest_name, msg_count, body):
+    for i in xrange(msg_count):
+        client.send(dest_name, body)
+    # make sure the broker has them all before stopping the clock
+    client.send(dest_name, body, receipt=True)
+
+def blocking(client, dest_name, msg_count, body):
+    for i in xrange(msg_count):
+        client.send(dest_name, body, receipt=True)
+
+def pipelined(client, dest_name, msg_count, body):
+    for i in xrange(msg_count):
+        client.send_async(dest_name, body)
+    client.wait_for_receipts()
+
+if __name__ == "__main__":
+    msg_count = 20000
+    dest_name = "/memqueue/bench"
+    if len(sys.argv) > 1:
+        msg_count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        dest_name = sys.argv[2]
+    reactor = GeventReactor("127.0.0.1", PORT)
+    broker = radiator.Broker(memory_queue_max_size=msg_count * 4)
+    reactor.start_server(broker)
+    client = reactor.start_client_sync()
+    body = "x" * 100
+    for fn in (fire_and_forget, blocking, pipelined):
+        start = time.time()
+        fn(client, dest_name, msg_count, body)
+        secs = time.time() - start
+        print "%-16s %8d msgs/sec" % (fn.__name__, msg_count / secs)
+    client.disconnect()
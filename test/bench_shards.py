@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# Sharded broker benchmark
+#   - runs the server with 1, 2, 4, ... workers (see shard.py)
+#   - one client process per worker sends to and consumes from its own
+#     memory queue; queues are spread over the workers by name, so some
+#     traffic is relayed between workers
+#   - reports aggregate throughput for each worker count
+#
+# usage: bench_shards.py [msgs_per_client] [max_workers]
+#
+
+import os
+import sys
+import time
+import socket
+import subprocess
+import multiprocessing
+sys.path.insert(0, os.path.dirname(__file__) + os.sep + "..")
+
+import gevent
+import radiator
+from radiator.reactor import GeventReactor
+
+PORT = 61616
+
+def serve(workers):
+    radiator.start_server(GeventReactor("127.0.0.1", PORT), workers=workers)
+
+def wait_for_server():
+    # plain socket: the clients are forked from this process later, so
+    # it must not use gevent
+    for i in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", PORT)).close()
+            return
+        except IOError:
+            time.sleep(0.05)
+    raise IOError("server didn't start")
+
+def client(dest_name, msg_count):
+    reactor = GeventReactor("127.0.0.1", PORT)
+    consumer = reactor.start_client_sync()
+    producer = reactor.start_client_sync()
+    received = [ 0 ]
+    def on_msg(c, msg_id, body):
+        received[0] += 1
+    consumer.subscribe(dest_name, on_msg, prefetch_count=100)
+
+    def produce():
+        for i in xrange(msg_count):
+            producer.send(dest_name, "x" * 100)
+            if i % 100 == 0:
+                gevent.sleep(0)
+
+    def consume():
+        while received[0] < msg_count:
+            if consumer.drain(timeout=5) == 0:
+                break
+
+    gevent.joinall([ gevent.spawn(produce), gevent.spawn(consume) ])
+    producer.disconnect()
+    consumer.disconnect()
+    return received[0]
+
+def bench(workers, msg_count):
+    server = subprocess.Popen([ sys.executable, __file__, "serve",
+                                str(workers) ])
+    pool = multiprocessing.Pool(workers)
+    try:
+        wait_for_server()
+        start = time.time()
+        results = [ pool.apply_async(client, ("/memqueue/bench.%d" % i,
+                                              msg_count))
+                    for i in range(workers) ]
+        total = sum([ r.get() for r in results ])
+        secs = time.time() - start
+        print "workers=%-3d %8d msgs/sec  (%d/%d)" % \
+              (workers, total / secs, total, msg_count * workers)
+    finally:
+        pool.terminate()
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "serve":
+        serve(int(sys.argv[2]))
+        sys.exit(0)
+    msg_count = 20000
+    max_workers = multiprocessing.cpu_count()
+    if len(sys.argv) > 1:
+        msg_count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        max_workers = int(sys.argv[2])
+    workers = 1
+    while workers <= max_workers:
+        bench(workers, msg_count)
+        workers *= 2
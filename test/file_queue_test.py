@@ -2,6 +2,9 @@
 
 import unittest
 import random
+import struct
+import time
+import uuid
 import sys, os
 sys.path.insert(0, os.path.dirname(__file__) + os.sep + "..")
 
@@ -45,21 +48,280 @@ class FileQueueTest(unittest.TestCase):
         q2.receive(True)
         self.assertEquals(1, q2.pending_messages())
         self.assertEquals(0, q2.in_use_messages())
-        self.assertEquals(116, os.path.getsize(q2.filename))
+        self.assertEquals(112, q2.disk_usage())
         msg = q2.receive(False)
         self.assertEquals((id, "1234"), (msg[1].id, msg[1].body))
         self.assertEquals(0, q2.pending_messages())
-        self.assertEquals(116, os.path.getsize(q2.filename))
+        self.assertEquals(112, q2.disk_usage())
         self.assertEquals(1, q2.in_use_messages())
         q2.ack(msg[1].id)
         self.assertEquals(0, q2.in_use_messages())
         self.assertEquals(0, q2.pending_messages())
-        self.assertEquals(12, os.path.getsize(q2.filename))
+        self.assertEquals(8, q2.disk_usage())
 
         q3 = radiator.FileQueue("test")
         self.assertEquals(0, q3.pending_messages())
         self.assertEquals(0, q3.in_use_messages())
 
+    def test_send_many(self):
+        q = radiator.FileQueue("test_segments", segment_size=100)
+        bodies = [ "x" * 30 for i in range(4) ]
+        ids = q.send_many(bodies)
+        # one write per segment
+        self.assertEquals(2, len(q._list_segments()))
+        self.assertEquals(4, q.pending_messages())
+        q.close()
+        q2 = radiator.FileQueue("test_segments")
+        self.assertEquals(ids, [ q2.receive(True)[1].id for i in range(4) ])
+        q2.destroy()
+
+    def test_acked_segments_are_unlinked(self):
+        q = radiator.FileQueue("test_segments", segment_size=100)
+        ids = [ q.send("x" * 60) for i in range(3) ]
+        self.assertEquals(3, len(q._list_segments()))
+        (msg_q, msg) = q.receive(False)
+        self.assertEquals(ids[0], msg.id)
+        self.assertEquals(3, len(q._list_segments()))
+        q.ack(msg.id)
+        self.assertEquals(2, len(q._list_segments()))
+        q.receive(True)
+        q.receive(True)
+        self.assertEquals(1, len(q._list_segments()))
+        self.assertEquals(8, q.disk_usage())
+        q.destroy()
+
+    def test_compact_sparse_segment(self):
+        q = radiator.FileQueue("test_compact", segment_size=1000,
+                               rewrite_interval_secs=0)
+        q.send("a")
+        for i in range(3):
+            q.send("z" * 300)
+        q.send("next segment")
+        self.assertEquals(2, len(q._list_segments()))
+        held = q.receive(False)[1]
+        for i in range(3):
+            q.ack(q.receive(False)[1].id)
+        stats = q.stats()
+        self.assertEquals(1, stats["compactions"])
+        self.assertEquals(3 * 348, stats["bytes_reclaimed"])
+        self.assertEquals(8 + 49, os.path.getsize(q._segment_path(1)))
+        self.assertTrue(q.msg_in_use(held.id))
+
+        q2 = radiator.FileQueue("test_compact")
+        self.assertTrue(q2.loaded_from_index)
+        self.assertTrue(q2.msg_in_use(held.id))
+        q2.ack(held.id)
+        self.assertEquals([2], q2._list_segments())
+        q2.destroy()
+
+    def test_sparse_segment_with_new_sends_not_compacted(self):
+        q = radiator.FileQueue("test_compact", segment_size=2000,
+                               rewrite_interval_secs=0)
+        big = q.send("z" * 1000)
+        q.send("a")
+        for i in range(2):
+            q.receive(False)
+        q.requeue_expired(radiator.now_millis() + 10**9)
+        # acking a requeued message leaves the segment marked sparse
+        q.ack(big)
+        self.assertEquals(set([1]), q.sparse)
+        a = q.receive(False)[1]
+        q.send("new")
+        q.ack(a.id)
+        self.assertEquals(0, q.stats()["compactions"])
+        self.assertEquals(1, q.pending_messages())
+        self.assertEquals("new", q.receive(True)[1].body)
+        q.destroy()
+
+    def test_small_tail_segment_not_sealed(self):
+        q = radiator.FileQueue("test_compact", segment_size=100000,
+                               ack_timeout=-1, rewrite_interval_secs=0)
+        for i in range(50):
+            for j in range(20):
+                q.send("x" * 100)
+            held = q.receive(False)[1]
+            for j in range(19):
+                q.ack(q.receive(False)[1].id)
+            q.ack(held.id)
+        self.assertEquals(0, q.stats()["compactions"])
+        self.assertEquals(1, len(q._list_segments()))
+        q.destroy()
+
+    def test_background_compaction_catches_up(self):
+        worker = radiator.BackgroundWorker()
+        q = radiator.FileQueue("test_compact", segment_size=1000,
+                               rewrite_interval_secs=0, worker=worker)
+        q.send("a")
+        q.send("b")
+        for i in range(3):
+            q.send("z" * 300)
+        q.send("next segment")
+        held = [ q.receive(False)[1], q.receive(False)[1] ]
+        for i in range(3):
+            q.ack(q.receive(False)[1].id)
+        self.assertEquals(set([1]), q.compacting)
+        # acked while the copy is running
+        q.ack(held[0].id)
+        while not worker.done:
+            time.sleep(0.01)
+        worker.poll()
+        self.assertEquals(1, q.stats()["compactions"])
+        self.assertEquals(8 + 49 * 2, os.path.getsize(q._segment_path(1)))
+
+        q2 = radiator.FileQueue("test_compact")
+        self.assertEquals(1, q2.in_use_messages())
+        self.assertTrue(q2.msg_in_use(held[1].id))
+        q2.destroy()
+
+    def test_migrate_single_file(self):
+        self.q.destroy()
+        f = open(self.q.filename, "wb")
+        f.write(struct.pack("q", 12))
+        f.write(struct.pack("i", 1))
+        acked = radiator.MessageHeader(12, 1, 2, 0, uuid.uuid4(), 0, 0)
+        acked.write(f, "", "acked")
+        pending = radiator.MessageHeader(69, 1, 0, 0, uuid.uuid4(), 0, 0)
+        pending.write(f, "", "pending")
+        f.close()
+
+        q = self.q = radiator.FileQueue("test")
+        self.assertFalse(os.path.exists(q.filename))
+        self.assertEquals(1, q.pending_messages())
+        (msg_q, msg) = q.receive(True)
+        self.assertEquals((pending.id, "pending"), (msg.id, msg.body))
+
+    def test_restart_from_checkpoint(self):
+        q = self.q
+        ids = [ q.send(str(i)) for i in range(4) ]
+        in_use = q.receive(False)[1]
+        q.receive(True)
+        q.checkpoint()
+        # changes after the checkpoint are replayed from the segments
+        q.ack(in_use.id)
+        in_use = q.receive(False)[1]
+        id = q.send("4")
+
+        q2 = radiator.FileQueue("test")
+        self.assertTrue(q2.loaded_from_index)
+        self.assertEquals(2, q2.pending_messages())
+        self.assertEquals(1, q2.in_use_messages())
+        self.assertTrue(q2.msg_in_use(in_use.id))
+        msg = q2.receive(True)[1]
+        self.assertEquals((ids[3], "3"), (msg.id, msg.body))
+        msg = q2.receive(True)[1]
+        self.assertEquals((id, "4"), (msg.id, msg.body))
+
+    def test_expired_messages_requeued_in_place(self):
+        q = self.q
+        ids = [ q.send(str(i)) for i in range(3) ]
+        q.receive(False)
+        in_use = q.receive(False)[1]
+        q.ack(in_use.id)
+        q.checkpoint()
+        usage = q.disk_usage()
+        q.requeue_expired(radiator.now_millis() + 1000000)
+        self.assertEquals(usage, q.disk_usage())
+        self.assertEquals(2, q.pending_messages())
+        self.assertEquals(0, q.in_use_messages())
+
+        # replayed from the checkpoint
+        q2 = radiator.FileQueue("test")
+        self.assertTrue(q2.loaded_from_index)
+        self.assertEquals(2, q2.pending_messages())
+        self.assertEquals(1, len(q2.requeued))
+
+        # found by a full rescan, and received first
+        os.remove(q.index_filename)
+        q3 = radiator.FileQueue("test")
+        self.assertFalse(q3.loaded_from_index)
+        self.assertEquals(2, q3.pending_messages())
+        self.assertEquals(ids[0], q3.receive(True)[1].id)
+        self.assertEquals(ids[2], q3.receive(True)[1].id)
+
+    def test_body_cache(self):
+        q = radiator.FileQueue("test_cache", body_cache_bytes=10)
+        q.send("12345")
+        q.send("67890")
+        # evicts "12345"
+        q.send("abc")
+        self.assertEquals(8, q.stats()["cache_bytes"])
+        self.assertEquals(["12345", "67890", "abc"],
+                          [ q.receive(True)[1].body for i in range(3) ])
+        stats = q.stats()
+        self.assertEquals((2, 1), (stats["cache_hits"], stats["cache_misses"]))
+        self.assertEquals((0, 0), (stats["cache_entries"], stats["cache_bytes"]))
+
+        # nothing is cached after a restart
+        q.send("def")
+        q.close()
+        q2 = radiator.FileQueue("test_cache")
+        self.assertEquals("def", q2.receive(True)[1].body)
+        self.assertEquals(1, q2.stats()["cache_misses"])
+        q2.destroy()
+
+    def test_compressed_bodies(self):
+        offloaded = [ ]
+        def offload(fn, *args):
+            offloaded.append(len(args[0]))
+            return fn(*args)
+        q = radiator.FileQueue("test_compress", compress_files=True,
+                               compress_min_bytes=100, offload=offload,
+                               offload_min_bytes=5000, body_cache_bytes=0)
+        bodies = [ "small", "x" * 1000, "y" * 10000, os.urandom(200) ]
+        q.send_many(bodies)
+        self.assertEquals([10000], offloaded)
+        self.assertTrue(q.disk_usage() < 1000)
+        self.assertEquals(bodies[:2],
+                          [ q.receive(True)[1].body for i in range(2) ])
+
+        q2 = radiator.FileQueue("test_compress")
+        self.assertEquals(bodies[2:],
+                          [ q2.receive(True)[1].body for i in range(2) ])
+        q2.destroy()
+
+    def test_message_headers(self):
+        q = radiator.FileQueue("test_headers", compress_files=True,
+                               compress_min_bytes=100)
+        q.send_many([ "a", "b" * 1000 ],
+                    [ "reply-to:/memqueue/r\ncorrelation-id:1", "" ])
+        msg = q.receive(True)[1]
+        self.assertEquals(("a", "reply-to:/memqueue/r\ncorrelation-id:1"),
+                          (msg.body, msg.headers))
+        q.send("c", "correlation-id:2")
+
+        # read back from disk
+        q2 = radiator.FileQueue("test_headers")
+        self.assertEquals([ ("b" * 1000, ""), ("c", "correlation-id:2") ],
+                          [ (m.body, m.headers) for (d, m) in
+                            [ q2.receive(True) for i in range(2) ] ])
+        q2.destroy()
+
+    def test_invalid_checkpoint_rescans(self):
+        q = self.q
+        q.send("abcd")
+        q.checkpoint()
+        f = open(q.index_filename, "r+b")
+        f.seek(20)
+        f.write("garbage")
+        f.close()
+        q2 = radiator.FileQueue("test")
+        self.assertFalse(q2.loaded_from_index)
+        self.assertEquals(1, q2.pending_messages())
+
+    def test_group_commit_defers_receipt(self):
+        b = radiator.Broker(group_commit=True)
+        receipts = [ ]
+        b.send("test_gc", "abcd", on_commit=lambda: receipts.append(1))
+        b.send("test_gc", "1234", on_commit=lambda: receipts.append(2))
+        q = b.dest_dict["test_gc"]
+        self.assertEquals([ ], receipts)
+        self.assertTrue(b.committer.dirty.has_key("test_gc"))
+        b.committer.commit(force=True)
+        self.assertEquals([1, 2], receipts)
+        self.assertEquals(0, len(b.committer.dirty))
+        self.assertEquals(2, q.pending_messages())
+        q.destroy()
+
     def _test_queue_name_validation(self):
         valid = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ-_.0123456789"
         for i in range(200):
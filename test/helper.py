@@ -3,6 +3,7 @@ import os
 import sys
 import logging
 import base64
+import glob
 import time
 
 from radiator import Broker
@@ -41,12 +42,22 @@ class BaseScenarioRunner(object):
         assert a > b, "%s <= %s" % (str(a), str(b))
 
     def reset_files(self):
-        basename = base64.urlsafe_b64encode(self.dest_name)
-        self.filename = os.path.join(self.dir, "%s.msg.dat" % basename)
-        if os.path.exists(self.filename):
-            os.remove(self.filename)
+        for filename in self.queue_files():
+            os.remove(filename)
         return self
 
+    def queue_files(self):
+        basename = base64.urlsafe_b64encode(self.dest_name)
+        return glob.glob(os.path.join(self.dir, "%s.*.seg" % basename)) + \
+               glob.glob(os.path.join(self.dir, "%s.msg.dat" % basename)) + \
+               glob.glob(os.path.join(self.dir, "%s.idx" % basename))
+
+    def disk_usage(self):
+        total = 0
+        for filename in self.queue_files():
+            total += os.path.getsize(filename)
+        return total
+
     def start_server(self):
         broker = Broker(self.dir,
                         self.fsync_millis,
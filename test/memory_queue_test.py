@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import unittest
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__) + os.sep + "..")
+
+import radiator
+
+class MemoryQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.q = radiator.MemoryQueue("/memqueue/test", max_size=3)
+
+    def test_deferred_ack(self):
+        q = self.q
+        id = q.send("abc")
+        (msg_q, msg) = q.receive(False)
+        self.assertEquals(q, msg_q)
+        self.assertEquals("abc", msg.body)
+        self.assertTrue(q.msg_in_use(id))
+        q.ack(id)
+        self.assertFalse(q.msg_in_use(id))
+        self.assertEquals(None, q.receive(True))
+
+    def test_max_size(self):
+        q = self.q
+        for i in range(3):
+            q.send("msg %d" % i)
+        self.assertRaises(radiator.RadiatorQueueFull, q.send, "too many")
+        # in use messages still count
+        q.receive(False)
+        self.assertRaises(radiator.RadiatorQueueFull, q.send, "too many")
+        q.receive(True)
+        q.send("fits")
+        self.assertEquals(2, q.pending_messages())
+
+    def test_expired_messages_requeued(self):
+        q = radiator.MemoryQueue("/memqueue/test", ack_timeout=10)
+        id = q.send("acked")
+        q.receive(False)
+        expired = q.send("expired")
+        q.receive(False)
+        q.send("pending")
+        q.ack(id)
+        q.requeue_expired(radiator.now_millis() + 20000)
+        # requeued ahead of the pending message
+        (msg_q, msg) = q.receive(True)
+        self.assertEquals(expired, msg.id)
+        self.assertEquals(0, q.in_use_messages())
+        self.assertEquals(1, q.pending_messages())
+
+    def test_broker_creates_by_prefix(self):
+        b = radiator.Broker(memory_queue_max_size=1)
+        b.send("/memqueue/jobs", "job")
+        self.assertTrue(isinstance(b.dest_dict["/memqueue/jobs"],
+                                   radiator.MemoryQueue))
+        self.assertRaises(radiator.RadiatorQueueFull,
+                          b.send, "/memqueue/jobs", "job")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import unittest
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__) + os.sep + "..")
+
+import gevent
+
+import radiator
+from radiator import RadiatorError
+from radiator.reactor import GeventReactor
+from radiator.pool import StompClientPool
+
+class StompClientPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        # two brokers
+        self.brokers = [ ]
+        self.servers = [ ]
+        for i in range(2):
+            broker = radiator.Broker(memory_queue_max_size=100)
+            server = GeventReactor("127.0.0.1", 0).create_server(
+                broker, ("127.0.0.1", 0))
+            server.start()
+            self.brokers.append(broker)
+            self.servers.append(server)
+        self.pool = StompClientPool([ ("127.0.0.1", s.server_port)
+                                      for s in self.servers ], size=4,
+                                    backoff_secs=10)
+
+    def tearDown(self):
+        self.pool.close()
+        for server in self.servers:
+            server.stop()
+
+    def pending(self, i):
+        dest = self.brokers[i].dest_dict.get("/memqueue/a")
+        return dest and dest.pending_messages() or 0
+
+    def test_sends_spread_over_brokers(self):
+        def produce():
+            for i in range(10):
+                self.pool.send("/memqueue/a", "x", receipt=True)
+        gevent.joinall([ gevent.spawn(produce) for i in range(4) ])
+        self.assertEquals(40, self.pending(0) + self.pending(1))
+        self.assertTrue(self.pending(0) > 0 and self.pending(1) > 0)
+
+    def test_broker_down(self):
+        self.pool.send("/memqueue/a", "x", receipt=True)
+        self.servers[0].stop()
+        gevent.sleep(0.05)
+        # the connection to broker 0 fails, its slot connects to broker 1
+        for i in range(4):
+            self.pool.send("/memqueue/a", "x", receipt=True)
+        self.assertEquals(4, self.pending(1))
+        self.assertEquals(1, self.pool.failures[0])
+        self.assertTrue(self.pool.retry_at[0] > 0)
+
+    def test_broker_down_without_receipts(self):
+        # connect every slot, two of them to broker 0
+        for i in range(4):
+            self.pool.send("/memqueue/a", "x", receipt=True)
+        self.assertEquals(2, self.pending(0))
+        self.servers[0].stop()
+        gevent.sleep(0.05)
+        # the first write on a dead connection may be lost, the next
+        # one fails and is retried on broker 1
+        for i in range(12):
+            self.pool.send("/memqueue/a", "x")
+        self.pool.send("/memqueue/a", "x", receipt=True)
+        self.assertTrue(self.pending(1) >= 2 + 12 - 2 + 1)
+
+    def test_broker_error_keeps_connection(self):
+        pool = StompClientPool([ ("127.0.0.1", self.servers[0].server_port) ],
+                               size=1)
+        with pool.client() as c:
+            c.on_error = lambda message, body: None
+            for i in range(100):
+                c.send_async("/memqueue/a", "x")
+            c.wait_for_receipts()
+        # the queue is full
+        self.assertRaises(RadiatorError, pool.send, "/memqueue/a", "x",
+                          receipt=True)
+        with pool.client() as c2:
+            self.assertTrue(c is c2)
+        pool.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import unittest
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__) + os.sep + "..")
+
+import gevent
+from gevent.socket import socketpair
+
+import radiator
+from radiator import RadiatorTimeout
+from radiator.reactor import GeventReactor, GeventConnection
+
+class SlowConsumerTest(unittest.TestCase):
+
+    def setUp(self):
+        (self.server_sock, self.client_sock) = socketpair()
+
+    def tearDown(self):
+        self.server_sock.close()
+        self.client_sock.close()
+
+    def send_frames(self, policy):
+        conn = GeventConnection(self.server_sock, max_outbound_bytes=10,
+                                policy=policy)
+        # nothing is written until this greenlet yields
+        conn.send_lossy("aaaa")
+        conn.send_lossy("bbbb")
+        conn.send_lossy("cccc")
+        gevent.sleep(0)
+        return conn
+
+    def received(self):
+        self.client_sock.settimeout(1)
+        return self.client_sock.recv(100)
+
+    def test_drop_oldest(self):
+        conn = self.send_frames("drop-oldest")
+        self.assertEquals("bbbbcccc", self.received())
+        self.assertEquals(1, conn.stats["dropped_oldest"])
+        self.assertEquals(0, conn.outbound_bytes)
+
+    def test_drop_newest(self):
+        conn = self.send_frames("drop-newest")
+        self.assertEquals("aaaabbbb", self.received())
+        self.assertEquals(1, conn.stats["dropped_newest"])
+
+    def test_disconnect(self):
+        conn = self.send_frames("disconnect")
+        self.assertEquals("", self.received())
+        self.assertEquals(1, conn.stats["disconnected"])
+        conn.send("dddd")
+        self.assertEquals(0, conn.outbound_bytes)
+
+class ClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = radiator.Broker(memory_queue_max_size=20)
+        self.server = GeventReactor("127.0.0.1", 0).create_server(
+            self.broker, ("127.0.0.1", 0))
+        self.server.start()
+        self.reactor = GeventReactor("127.0.0.1", self.server.server_port)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_concurrent_calls(self):
+        # replies in reverse order, and never to "slow"
+        requests = [ ]
+        def on_request(c, msg_id, body):
+            requests.append((dict(c.message_headers), body))
+            if len(requests) == 3:
+                for (headers, body) in reversed(requests):
+                    if body != "slow":
+                        c.reply(headers, body.upper())
+        server = self.reactor.start_client_sync()
+        server.subscribe("/memqueue/rpc", on_request)
+        gevent.spawn(server.drain)
+
+        client = self.reactor.start_client_sync()
+        def call(body):
+            try:
+                return client.call("/memqueue/rpc", body, timeout=0.5)
+            except RadiatorTimeout:
+                return None
+        calls = [ gevent.spawn(call, body) for body in ("a", "slow", "b") ]
+        gevent.joinall(calls, timeout=5)
+        self.assertEquals(["A", None, "B"], [ g.value for g in calls ])
+        self.assertEquals({ }, client.calls)
+        # replies don't create destinations, and unanswered reply-to
+        # destinations expire
+        self.assertEquals([ "/memqueue/rpc" ], self.broker.dest_dict.keys())
+        self.assertEquals(1, len(self.broker.replies))
+        self.broker.tick()
+        self.assertEquals({ }, self.broker.replies)
+        client.disconnect()
+        server.disconnect()
+
+    def test_pipelined_receipts(self):
+        client = self.reactor.start_client_sync()
+        client.receipt_window = 8
+        results = [ ]
+        def on_receipt(c, receipt_id, error):
+            results.append(error)
+        pending = [ client.send_async("/memqueue/a", "%d" % i,
+                                      on_receipt=on_receipt)
+                    for i in range(25) ]
+        # the window was filled twice, so some were read already
+        self.assertTrue(len(results) >= 8)
+        client.wait_for_receipts(timeout_sec=5)
+        self.assertEquals([ None ] * 20, results[:20])
+        # the queue only holds 20
+        self.assertEquals(5, len([ e for e in results[20:] if e ]))
+        self.assertTrue(pending[0].done)
+        self.assertEquals({ }, client.receipts)
+
+        # blocking receipts
+        client.on_error = lambda message, body: None
+        client.subscribe("/memqueue/b", lambda c, msg_id, body: None,
+                         receipt=True)
+        self.assertRaises(IOError, client.send, "/memqueue/a", "x",
+                          receipt=True)
+        client.disconnect()
+
+class TickTest(unittest.TestCase):
+
+    def test_tick_continues_after_error(self):
+        broker = radiator.Broker()
+        ticks = [ ]
+        def tick():
+            ticks.append(1)
+            if len(ticks) == 1:
+                raise IOError("disk full")
+        broker.tick = tick
+        GeventReactor("127.0.0.1", 0).start_server(broker,
+                                                   listener=("127.0.0.1", 0))
+        gevent.sleep(0.1)
+        self.assertTrue(len(ticks) > 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,7 +9,6 @@
 
 import helper
 import time
-import os
 
 msgs_recvd = [ ]
 def on_msg(consumer_id, client, msg_id, body):    
@@ -36,7 +35,7 @@ for i in range(0, 10):
 for g in gl:
     g.join()
 
-fsize = os.path.getsize(scenario.filename)
+fsize = scenario.disk_usage()
 scenario.lt(fsize, (msg_count*1072*.11))
     
 scenario.success("scenario_disk_reclaim")
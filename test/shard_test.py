@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import unittest
+import shutil
+import tempfile
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__) + os.sep + "..")
+
+import gevent
+from gevent.socket import AF_UNIX
+
+import radiator
+from radiator.reactor import GeventReactor
+from radiator.stomp import FrameParser
+from radiator.shard import ShardedStompServer, shard_of, shard_path, listen
+
+class RecordingConnection(object):
+
+    def __init__(self):
+        self.sent = [ ]
+
+    def send(self, *parts):
+        self.sent.append("".join(parts))
+
+    send_lossy = send
+
+    def flush(self):
+        pass
+
+class ShardTest(unittest.TestCase):
+
+    def setUp(self):
+        # two workers in this process, linked over unix sockets
+        self.sock_dir = tempfile.mkdtemp()
+        self.brokers = [ radiator.Broker(), radiator.Broker() ]
+        self.servers = [ ]
+        reactor = GeventReactor("127.0.0.1", 0)
+        for shard in range(2):
+            listener = listen(AF_UNIX, shard_path(self.sock_dir, shard))
+            server = reactor.create_server(self.brokers[shard], listener)
+            server.start()
+            self.servers.append(server)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.sock_dir)
+
+    def client(self, shard=0):
+        conn = RecordingConnection()
+        server = ShardedStompServer(conn, self.brokers[shard], shard, 2,
+                                    self.sock_dir)
+        server.feed("CONNECT\n\n\x00")
+        return (conn, server)
+
+    def replies(self, conn):
+        gevent.sleep(0.05)
+        return FrameParser().feed("".join(conn.sent))
+
+    def owned_by(self, shard):
+        i = 0
+        while shard_of("/memqueue/jobs.%d" % i, 2) != shard:
+            i += 1
+        return "/memqueue/jobs.%d" % i
+
+    def test_remote_destination(self):
+        (conn, server) = self.client()
+        dest_name = self.owned_by(1)
+        server.feed("SEND\ndestination:%s\nreceipt:1\n\nhello\x00" % dest_name)
+        server.feed("SUBSCRIBE\ndestination:%s\nack:client\nid:s1\n\n\x00" %
+                    dest_name)
+        frames = self.replies(conn)
+        self.assertEquals(["CONNECTED", "RECEIPT", "MESSAGE"],
+                          [ f["command"] for f in frames ])
+        self.assertEquals("hello", frames[2]["body"])
+        self.assertEquals("s1", frames[2]["headers"]["subscription"])
+        self.assertFalse(self.brokers[0].dest_dict.has_key(dest_name))
+        dest = self.brokers[1].dest_dict[dest_name]
+        self.assertEquals(1, dest.in_use_messages())
+
+        server.feed("ACK\nmessage-id:%s\n\n\x00" %
+                    frames[2]["headers"]["message-id"])
+        gevent.sleep(0.05)
+        self.assertEquals(0, dest.in_use_messages())
+
+        # the link's session ends with the client's
+        server.closed()
+        gevent.sleep(0.05)
+        self.assertEquals({ }, self.brokers[1].session_dict)
+
+    def test_wildcard_spans_workers(self):
+        (conn, server) = self.client()
+        server.feed("SUBSCRIBE\ndestination:/memqueue/jobs.*\n\n\x00")
+        gevent.sleep(0.05)
+        for shard in range(2):
+            server.feed("SEND\ndestination:%s\n\n%d\x00" %
+                        (self.owned_by(shard), shard))
+        frames = self.replies(conn)
+        self.assertEquals(["0", "1"],
+                          sorted([ f["body"] for f in frames
+                                   if f["command"] == "MESSAGE" ]))
+        server.closed()
+
+    def test_reply_routed_to_caller(self):
+        (conn, server) = self.client()
+        (responder_conn, responder) = self.client(1)
+        dest_name = self.owned_by(1)
+        responder.feed("SUBSCRIBE\ndestination:%s\n\n\x00" % dest_name)
+        server.feed("SEND\ndestination:%s\nreply-to:/reply/abc\n"
+                    "correlation-id:7\n\nping\x00" % dest_name)
+        request = self.replies(responder_conn)[-1]
+        self.assertEquals("/reply/0.abc", request["headers"]["reply-to"])
+
+        responder.feed("SEND\ndestination:/reply/0.abc\ncorrelation-id:7\n\n"
+                       "pong\x00")
+        reply = self.replies(conn)[-1]
+        self.assertEquals(("pong", "7"),
+                          (reply["body"], reply["headers"]["correlation-id"]))
+        self.assertEquals({ }, self.brokers[0].replies)
+        self.assertEquals([ dest_name ], self.brokers[1].dest_dict.keys())
+        responder.closed()
+        server.closed()
+
+if __name__ == "__main__":
+    unittest.main()
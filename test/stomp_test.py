@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+import unittest
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__) + os.sep + "..")
+
+import radiator
+from radiator.stomp import FrameParser, BaseStompConnection, StompServer
+
+class RecordingConnection(object):
+
+    def __init__(self, reads=None):
+        self.sent  = [ ]
+        self.parts = [ ]
+        self.reads = list(reads or [ ])
+
+    def recv(self):
+        if not self.reads:
+            raise BufferError("disconnected")
+        return self.reads.pop(0)
+
+    def flush(self):
+        pass
+
+    def send(self, *parts):
+        self.sent.append("".join(parts))
+        self.parts.append(parts)
+
+    send_lossy = send
+
+class FrameParserTest(unittest.TestCase):
+
+    def test_several_frames_in_one_read(self):
+        data = "CONNECT\n\n\x00\n" + \
+               "SEND\ndestination:/queue/a\n\nhello\n\x00\n" + \
+               "SEND\r\ndestination:/queue/b\r\ncontent-length:5\r\n\r\n" + \
+               "a\x00b\nc\x00"
+        frames = FrameParser().feed(data)
+        self.assertEquals(["CONNECT", "SEND", "SEND"],
+                          [ f["command"] for f in frames ])
+        self.assertEquals("", frames[0]["body"])
+        self.assertEquals("/queue/a", frames[1]["headers"]["destination"])
+        self.assertEquals("hello", frames[1]["body"])
+        self.assertEquals("/queue/b", frames[2]["headers"]["destination"])
+        self.assertEquals("a\x00b\nc", frames[2]["body"])
+
+    def test_frame_split_across_reads(self):
+        data = "SEND\ndestination:/queue/a\ncontent-length:10\n\n" + \
+               "0123456789\x00SEND\ndestination:/queue/a\n\nlast\x00"
+        p = FrameParser()
+        frames = [ ]
+        for i in range(0, len(data), 3):
+            frames.extend(p.feed(data[i:i+3]))
+        self.assertEquals(["0123456789", "last"],
+                          [ f["body"] for f in frames ])
+        self.assertEquals([ ], p.feed("\n"))
+        self.assertEquals(1, p.buffered)
+
+class WriteFrameTest(unittest.TestCase):
+
+    def test_frame_is_sent_as_one_buffer(self):
+        conn = RecordingConnection()
+        c = BaseStompConnection(conn)
+        c._write_frame("MESSAGE", headers=["destination:/queue/a"],
+                       body="a\x00b")
+        c._write_frame("RECEIPT", headers=["receipt:1"])
+        self.assertEquals(2, len(conn.sent))
+        frames = FrameParser().feed("".join(conn.sent))
+        self.assertEquals("a\x00b", frames[0]["body"])
+        self.assertEquals("3", frames[0]["headers"]["content-length"])
+        self.assertEquals("1", frames[1]["headers"]["receipt"])
+
+class TopicFanOutTest(unittest.TestCase):
+
+    def test_message_frame_encoded_once(self):
+        broker = radiator.Broker()
+        conns = [ RecordingConnection(), RecordingConnection() ]
+        for conn in conns:
+            server = StompServer(conn, broker)
+            server._connect({ })
+            headers = { "destination" : "/topic/a" }
+            if conn == conns[1]:
+                headers["id"] = "sub-1"
+            server._subscribe({ "command" : "SUBSCRIBE",
+                                "headers" : headers })
+        broker.send("/topic/a", "hello")
+
+        # both subscribers queue the same encoded frame
+        self.assertTrue(conns[0].parts[-1][1] is conns[1].parts[-1][1])
+        frames = [ FrameParser().feed(c.sent[-1])[0] for c in conns ]
+        self.assertEquals(["hello", "hello"], [ f["body"] for f in frames ])
+        self.assertFalse(frames[0]["headers"].has_key("subscription"))
+        self.assertEquals("sub-1", frames[1]["headers"]["subscription"])
+        # the encoded frame isn't kept once all subscribers have it
+        self.assertEquals({ }, broker.fanout_cache)
+
+    def test_wildcard_subscription_id(self):
+        broker = radiator.Broker()
+        conn = RecordingConnection()
+        server = StompServer(conn, broker)
+        server._connect({ })
+        for (dest, id) in [ ("/topic/logs.>", "all"),
+                            ("/topic/logs.web", "web") ]:
+            server._subscribe({ "command" : "SUBSCRIBE",
+                                "headers" : { "destination" : dest,
+                                              "id" : id } })
+        broker.send("/topic/logs.email", "a")
+        broker.send("/topic/logs.web", "b")
+        frames = FrameParser().feed("".join(conn.sent[1:]))
+        self.assertEquals([ "all", "web" ],
+                          [ f["headers"]["subscription"] for f in frames ])
+
+class BatchSendTest(unittest.TestCase):
+
+    def test_sends_in_one_read_are_batched(self):
+        broker = radiator.Broker(memory_queue_max_size=3)
+        batches = [ ]
+        send_many = broker.send_many
+        def record(dest_name, bodies, on_commit=None, headers=None):
+            batches.append((dest_name, bodies))
+            send_many(dest_name, bodies, on_commit, headers)
+        broker.send_many = record
+        frames = [ "CONNECT\n\n\x00" ]
+        for (dest, body) in [ ("a", "1"), ("a", "2"), ("b", "3"),
+                              ("a", "4"), ("a", "5") ]:
+            frames.append("SEND\ndestination:/memqueue/%s\nreceipt:%s\n\n"
+                          "%s\x00" % (dest, body, body))
+        conn = RecordingConnection([ "".join(frames) ])
+        StompServer(conn, broker).drain()
+
+        self.assertEquals([ ("/memqueue/a", ["1", "2"]),
+                            ("/memqueue/b", ["3"]),
+                            ("/memqueue/a", ["4", "5"]) ], batches[:3])
+        # the last batch didn't fit, so it was retried one at a time
+        replies = FrameParser().feed("".join(conn.sent))
+        self.assertEquals(["CONNECTED"] + ["RECEIPT"] * 4 + ["ERROR"],
+                          [ f["command"] for f in replies ])
+        self.assertEquals("5", replies[-1]["headers"]["receipt-id"])
+
+class BrokerHeadersTest(unittest.TestCase):
+
+    def test_producer_cannot_override_message_headers(self):
+        broker = radiator.Broker()
+        conn = RecordingConnection([ "CONNECT\n\n\x00" +
+            "SUBSCRIBE\ndestination:/memqueue/a\nid:sub-1\n\n\x00" +
+            "SEND\ndestination:/memqueue/a\nmessage-id:bogus\n" +
+            "subscription:other\nreply-to:/memqueue/b\n\nhello\x00" ])
+        StompServer(conn, broker).drain()
+        frames = FrameParser().feed("".join(conn.sent))
+        self.assertEquals("MESSAGE", frames[-1]["command"])
+        headers = frames[-1]["headers"]
+        self.assertEquals("/memqueue/a", headers["destination"])
+        self.assertTrue(headers["message-id"].endswith(",/memqueue/a"))
+        self.assertEquals("sub-1", headers["subscription"])
+        self.assertEquals("/memqueue/b", headers["reply-to"])
+
+    def test_malformed_ack_is_ignored(self):
+        broker = radiator.Broker()
+        conn = RecordingConnection([ "CONNECT\n\n\x00" +
+            "ACK\nmessage-id:bogus\n\n\x00" +
+            "ACK\nmessage-id:bogus,/memqueue/a\n\n\x00" +
+            "ACK\nmessage-id:%s,/memqueue/none\n\n\x00" %
+            ("0" * 32) + "SEND\ndestination:/memqueue/a\nreceipt:1\n\nx\x00" ])
+        StompServer(conn, broker).drain()
+        frames = FrameParser().feed("".join(conn.sent))
+        self.assertEquals(["CONNECTED", "RECEIPT"],
+                          [ f["command"] for f in frames ])
+        self.assertFalse(broker.dest_dict.has_key("/memqueue/none"))
+
+if __name__ == "__main__":
+    unittest.main()
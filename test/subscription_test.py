@@ -66,6 +66,213 @@ class SubscriptionTest(unittest.TestCase):
         self.assertEquals(s1, d1.subscribers["s1"])
         self.assertEquals(d1, s1.subscriptions["/topic/logs.email"].dest)
 
+    def test_prefetch_window(self):
+        received = [ ]
+        b = radiator.Broker()
+        for i in range(5):
+            b.send("d1", "msg %d" % i)
+        b.subscribe("d1", False, "s1",
+                    lambda dest_name, msg_id, body: received.append(msg_id),
+                    prefetch_count=3)
+        self.assertEquals(3, len(received))
+        b.ack("s1", received[0])
+        self.assertEquals(4, len(received))
+        self.assertEquals(3, len(b.session_dict["s1"].in_flight))
+        b.dest_dict["d1"].destroy()
+
+    def test_raising_prefetch_count_fills_window(self):
+        received = [ ]
+        b = radiator.Broker()
+        cb = lambda dest_name, msg_id, body: received.append(msg_id)
+        b.subscribe("/memqueue/a", False, "s1", cb)
+        for i in range(5):
+            b.send("/memqueue/a", "msg %d" % i)
+        self.assertEquals(1, len(received))
+        b.subscribe("/memqueue/b", False, "s1", cb, prefetch_count=10)
+        self.assertEquals(5, len(received))
+        a = b.dest_dict["/memqueue/a"]
+        self.assertEquals(0, a.pending_messages())
+        # s1 has room, so new messages go straight to it
+        b.send("/memqueue/a", "msg 5")
+        self.assertEquals(6, len(received))
+
+    def test_send_skips_busy_sessions(self):
+        received = { "s1" : [ ], "s2" : [ ] }
+        b = radiator.Broker()
+        d1 = b._get_or_create_dest("d1")
+        for session_id in [ "s1", "s2" ]:
+            b.subscribe("d1", False, session_id,
+                        lambda d, msg_id, body, r=received[session_id]:
+                            r.append(msg_id))
+        b.send("d1", "m1")
+        b.send("d1", "m2")
+        self.assertEquals([ 1, 1 ], [ len(received["s1"]),
+                                      len(received["s2"]) ])
+        self.assertEquals(0, len(d1.ready))
+
+        # nobody has room - stays pending until an ack
+        b.send("d1", "m3")
+        self.assertEquals(1, d1.pending_messages())
+        b.ack("s2", received["s2"][0])
+        self.assertEquals(2, len(received["s2"]))
+        self.assertEquals(0, d1.pending_messages())
+        d1.destroy()
+
+    def test_ack_only_readies_dests_that_skipped_session(self):
+        received = [ ]
+        b = radiator.Broker()
+        dests = [ b._get_or_create_dest("/memqueue/d%d" % i)
+                  for i in range(3) ]
+        for d in dests:
+            b.subscribe(d.name, False, "s1",
+                        lambda dest_name, msg_id, body:
+                            received.append(msg_id))
+        s1 = b.session_dict["s1"]
+        b.send("/memqueue/d0", "m1")
+        # window is full, d1 skips s1 and leaves it pending
+        b.send("/memqueue/d1", "m2")
+        self.assertEquals(["/memqueue/d0", "/memqueue/d1"],
+                          s1.nonempty.keys())
+        self.assertEquals(s1, dests[2].ready["s1"])
+
+        b.ack("s1", received[0])
+        self.assertEquals(2, len(received))
+        b.ack("s1", received[1])
+        self.assertEquals([ ], s1.nonempty.keys())
+        for d in dests:
+            self.assertEquals(s1, d.ready["s1"])
+        b.send("/memqueue/d1", "m3")
+        self.assertEquals(3, len(received))
+
+    def test_send_to_busy_subscribers_touches_none(self):
+        received = { }
+        b = radiator.Broker()
+        d1 = b._get_or_create_dest("/memqueue/d1")
+        count = 1000
+        for i in range(count):
+            b.subscribe("/memqueue/d1", False, i,
+                        lambda d, msg_id, body, i=i:
+                            received.__setitem__(i, msg_id))
+        for i in range(count):
+            b.send("/memqueue/d1", "job")
+        self.assertEquals(count, len(received))
+
+        # every session is busy: sends leave them alone
+        touched = [ ]
+        class CountingSession(radiator.Session):
+            def __getattribute__(self, name):
+                touched.append(name)
+                return radiator.Session.__getattribute__(self, name)
+        for session in b.session_dict.values():
+            session.__class__ = CountingSession
+        for i in range(100):
+            b.send("/memqueue/d1", "job")
+        self.assertEquals([ ], touched)
+        self.assertEquals(100, d1.pending_messages())
+
+        # an ack makes room, and the session pulls the next one
+        first = received[7]
+        b.ack(7, first)
+        self.assertNotEquals(first, received[7])
+        self.assertEquals(99, d1.pending_messages())
+
+    def test_destroy_session_requeues_in_flight(self):
+        received = { "s1" : [ ], "s2" : [ ] }
+        b = radiator.Broker()
+        d1 = b._get_or_create_dest("d1")
+        ids = [ b.send("d1", "msg %d" % i) for i in range(3) ]
+        for session_id in [ "s1", "s2" ]:
+            b.subscribe("d1", False, session_id,
+                        lambda d, msg_id, body, r=received[session_id]:
+                            r.append(body),
+                        prefetch_count=2)
+        self.assertEquals([ "msg 0", "msg 1" ], received["s1"])
+        self.assertEquals([ "msg 2" ], received["s2"])
+        b.destroy_session("s1")
+        # s1's messages go to s2 without waiting for the ack timeout
+        self.assertEquals([ "msg 2", "msg 0" ], received["s2"])
+        self.assertEquals(1, d1.pending_messages())
+        d1.destroy()
+
+    def test_destroy_session_after_redelivery(self):
+        for dest_name in [ "d1", "/memqueue/d1" ]:
+            received = { "s1" : [ ], "s2" : [ ], "s3" : [ ] }
+            b = radiator.Broker()
+            dest = b._get_or_create_dest(dest_name)
+            for session_id in [ "s1", "s2" ]:
+                b.subscribe(dest_name, False, session_id,
+                            lambda d, msg_id, body, r=received[session_id]:
+                                r.append(msg_id))
+            b.send(dest_name, "job")
+            # s1's ack timeout passes, and the job goes to s2
+            dest.requeue_expired(radiator.now_millis() + 10**9)
+            self.assertEquals(received["s1"], received["s2"])
+            b.subscribe(dest_name, False, "s3",
+                        lambda d, msg_id, body: received["s3"].append(msg_id))
+            # s2 still has it
+            b.destroy_session("s1")
+            self.assertEquals([ ], received["s3"])
+            self.assertEquals((0, 1), (dest.pending_messages(),
+                                       dest.in_use_messages()))
+            b.ack("s2", received["s2"][0])
+            self.assertEquals(0, dest.in_use_messages())
+            dest.destroy()
+
+    def test_round_robin_over_nonempty_dests(self):
+        received = [ ]
+        b = radiator.Broker()
+        for dest_name in [ "d1", "d2", "d3" ]:
+            b._get_or_create_dest(dest_name)
+        for i in range(3):
+            b.send("d1", "msg")
+            b.send("d2", "msg")
+        for dest_name in [ "d1", "d2", "d3" ]:
+            b.subscribe(dest_name, False, "s1",
+                        lambda d, msg_id, body: received.append(msg_id))
+        s1 = b.session_dict["s1"]
+        # d3 is empty and never polled
+        self.assertEquals([ "d1", "d2" ], s1.nonempty.keys())
+        for i in range(5):
+            b.ack("s1", received[-1])
+        self.assertEquals([ "d1", "d1", "d2", "d1", "d2", "d2" ],
+                          [ m.split(",")[1] for m in received ])
+        for dest_name in [ "d1", "d2", "d3" ]:
+            b.dest_dict[dest_name].destroy()
+
+    def test_subscribe_after_dest_created(self):
+        b = radiator.Broker()
+        b.send("/topic/logs.email", "my mesg")
+        b.send("/topic/logs.sms.us", "my mesg")
+        b.send("/topic/other", "my mesg")
+        b.subscribe("/topic/logs.*", True, "s1", lambda a,b,c: None)
+        s1 = b.session_dict["s1"]
+        self.assertEquals(["/topic/logs.*", "/topic/logs.email"],
+                          sorted(s1.subscriptions.keys()))
+        b.destroy_session("s1")
+        self.assertEquals([ ], b.subscription_tree.match("/topic/logs.x"))
+
+    def test_topic_tree(self):
+        t = radiator.TopicTree()
+        for pattern in [ "/topic/a.>", "/topic/a.*", "/topic/a.b",
+                         "*.b.c" ]:
+            t.add(pattern, "s1", pattern)
+        self.assertEquals([ "*.b.c", "/topic/a.>" ],
+                          sorted(t.match("/topic/a.b.c")))
+        self.assertEquals([ "/topic/a.*", "/topic/a.>", "/topic/a.b" ],
+                          sorted(t.match("/topic/a.b")))
+        self.assertEquals([ ], t.match("/topic/a"))
+        t.remove("/topic/a.>", "s1")
+        self.assertEquals([ "*.b.c" ], t.match("/topic/a.b.c"))
+
+        t = radiator.TopicTree()
+        for name in [ "/topic/a", "/topic/a.b", "/topic/a.b.c", "/topic/x.b" ]:
+            t.add(name, name, name)
+        self.assertEquals([ "/topic/a.b", "/topic/a.b.c" ],
+                          sorted(t.find("/topic/a.>")))
+        self.assertEquals([ "/topic/a.b" ], t.find("/topic/a.*"))
+        self.assertEquals([ "/topic/a.b", "/topic/x.b" ],
+                          sorted(t.find("*.b")))
+
     def test_dest_wildcard_matching(self):
         s = radiator.Subscription("/topic/foo.>", True, None)
         matches = [ "/topic/foo.1", "/topic/foo.bar.baz", "/topic/foo.z" ]
@@ -74,6 +281,9 @@ class SubscriptionTest(unittest.TestCase):
         non_matches = [ "/topic/foo", "/topic/blah", "/queue/foo.2" ]
         for m in non_matches:
             self.assertFalse(s.matches(m))
+        s = radiator.Subscription("/topic/foo.*.baz", True, None)
+        self.assertTrue(s.matches("/topic/foo.bar.baz"))
+        self.assertFalse(s.matches("/topic/foo.bar.baz.1"))
         
 
 if __name__ == "__main__":